@@ -124,7 +124,46 @@ FirstLevelEstimator_input_fields = [
             "help_string": "Type of smoothing (iso or isoblurto)'",
         }
         
-    )
+    ),
+    (
+        "n_procs",
+        int,
+        {
+            "help_string": "Number of CPUs the estimator may use",
+        },
+    ),
+    (
+        "compact_outputs",
+        bool,
+        {
+            "help_string": "Write contrast maps of NIfTI series as compact in-mask images, "
+            "which reference mask_file and are expanded to full volumes by BIDSDataSink",
+        },
+    ),
+    (
+        "atlas",
+        File,
+        {
+            "help_string": "Labelled atlas of a NIfTI series; if set, the model is fit to parcel "
+            "means, and maps are written as TSV tables with one row per parcel",
+        },
+    ),
+    (
+        "container_outputs",
+        bool,
+        {
+            "help_string": "Write all maps of the run into a single container with a JSON "
+            "sidecar index; map outputs are then references to maps of the container",
+        },
+    ),
+    (
+        "precision",
+        Literal["float32", "float64"],
+        {
+            "help_string": "Floating point precision of loaded data, model fits, contrasts "
+            "and output maps. If unset, data are held in float32 and models fit in float64",
+        },
+    ),
 ]
 
 
@@ -192,6 +231,13 @@ Estimator_output_spec = [
             "help_string": "model metadata",
         },
     ),
+    (
+        "map_container",
+        File,
+        {
+            "help_string": "container of all maps of the run, if container_outputs is set",
+        },
+    ),
 ]
 
 Estimator_output_spec = SpecInfo(
@@ -252,7 +298,69 @@ SecondLevelEstimator_input_fields = [
             "help_string": "Type of smoothing (iso or isoblurto)'",
         }
         
-    )
+    ),
+    (
+        "n_procs",
+        int,
+        {
+            "help_string": "Number of CPUs the estimator may use",
+        },
+    ),
+    (
+        "stream_batch_size",
+        int,
+        {
+            "help_string": "Fit OLS models by streaming input maps in batches of this size, "
+            "keeping only sufficient statistics in memory",
+        },
+    ),
+    (
+        "prior_stats",
+        File,
+        {
+            "help_string": "Sufficient statistics saved by a previous streamed fit, "
+            "to be updated with only the inputs added or removed since",
+        },
+    ),
+    (
+        "n_permutations",
+        int,
+        {
+            "help_string": "Number of permutations (or sign flips, for one-sample designs) "
+            "for nonparametric p-values. Ignored for meta-analyses",
+        },
+    ),
+    (
+        "random_seed",
+        int,
+        {
+            "help_string": "Seed for the random permutations",
+        },
+    ),
+    (
+        "mixed_effects",
+        bool,
+        {
+            "help_string": "Fit a mixed effects model, weighting inputs by their variance maps "
+            "and estimating the between-input variance",
+        },
+    ),
+    (
+        "atlas",
+        File,
+        {
+            "help_string": "Labelled atlas; if set, input maps are reduced to parcel means "
+            "before fitting. Parcel tables from first level models are fit as they are",
+        },
+    ),
+    (
+        "precision",
+        Literal["float32", "float64"],
+        {
+            "help_string": "Floating point precision of loaded data, model fits, contrasts "
+            "and output maps. If unset, data are held in float32 and models fit in float64",
+        },
+    ),
 ]
     
 SecondLevelEstimator_input_spec = SpecInfo(
@@ -270,7 +378,28 @@ SecondLevelEstimator_output_fields = [
         {
             "help_string": "contrast metadata"
         }
-    )
+    ),
+    (
+        "sufficient_stats",
+        File,
+        {
+            "help_string": "Sufficient statistics and input manifest of a streamed fit",
+        },
+    ),
+    (
+        "perm_pvalue_maps",
+        MultiOutputFile,
+        {
+            "help_string": "voxelwise permutation p-value maps",
+        },
+    ),
+    (
+        "fwe_pvalue_maps",
+        MultiOutputFile,
+        {
+            "help_string": "permutation p-value maps corrected with the maximum statistic",
+        },
+    ),
 ]
     
 SecondLevelEstimator_output_spec = SpecInfo(
@@ -282,4 +411,267 @@ SecondLevelEstimator_output_spec = SpecInfo(
 
 class SecondLevelEstimatorInterface(FunctionTask):
     input_spec = SecondLevelEstimator_input_spec
-    output_spec = SecondLevelEstimator_output_spec
\ No newline at end of file
+    output_spec = SecondLevelEstimator_output_spec
+
+
+BatchSecondLevelEstimator_input_fields = [
+    (
+        "specs",
+        list[dict],
+        {
+            "help_string": "second level specs, fit together when they share a design",
+            "mandatory": True,
+        },
+    ),
+    (
+        "effect_maps",
+        list[list[File]],
+        {
+            "help_string": "effect maps of each spec",
+            "mandatory": True,
+        },
+    ),
+    (
+        "stat_metadata",
+        list[list[dict]],
+        {
+            "help_string": "stat metadata of each spec",
+            "mandatory": True,
+        },
+    ),
+    (
+        "n_procs",
+        int,
+        {
+            "help_string": "Number of CPUs the estimator may use",
+        },
+    ),
+    (
+        "stream_batch_size",
+        int,
+        {
+            "help_string": "Stream input maps in batches of this size, "
+            "keeping only sufficient statistics in memory",
+        },
+    ),
+    (
+        "precision",
+        Literal["float32", "float64"],
+        {
+            "help_string": "Floating point precision of loaded data, model fits, contrasts "
+            "and output maps. If unset, data are held in float32 and models fit in float64",
+        },
+    ),
+]
+
+BatchSecondLevelEstimator_input_spec = SpecInfo(
+    name="BatchSecondLevelEstimatorInputSpec",
+    fields=BatchSecondLevelEstimator_input_fields,
+    bases=(BaseSpec,),
+)
+
+
+BatchSecondLevelEstimator_output_fields = [
+    (
+        "effect_maps",
+        list[list[File]],
+        {
+            "help_string": "effect maps of each spec",
+        },
+    ),
+    (
+        "variance_maps",
+        list[list[File]],
+        {
+            "help_string": "variance maps of each spec",
+        },
+    ),
+    (
+        "stat_maps",
+        list[list[File]],
+        {
+            "help_string": "stat maps of each spec",
+        },
+    ),
+    (
+        "zscore_maps",
+        list[list[File]],
+        {
+            "help_string": "zscore maps of each spec",
+        },
+    ),
+    (
+        "pvalue_maps",
+        list[list[File]],
+        {
+            "help_string": "pvalue maps of each spec",
+        },
+    ),
+    (
+        "contrast_metadata",
+        list[list[dict]],
+        {
+            "help_string": "contrast metadata of each spec",
+        },
+    ),
+]
+
+BatchSecondLevelEstimator_output_spec = SpecInfo(
+    name="BatchSecondLevelEstimatorOutputSpec",
+    fields=BatchSecondLevelEstimator_output_fields,
+    bases=(BaseSpec,),
+)
+
+
+class BatchSecondLevelEstimatorInterface(FunctionTask):
+    input_spec = BatchSecondLevelEstimator_input_spec
+    output_spec = BatchSecondLevelEstimator_output_spec
+
+
+MultiRunFirstLevelEstimator_input_fields = [
+    (
+        "bold_files",
+        list[File],
+        {
+            "help_string": "BOLD series of each run",
+            "mandatory": True,
+        },
+    ),
+    (
+        "mask_files",
+        list[File],
+        {
+            "help_string": "Brain mask of each run",
+        },
+    ),
+    (
+        "design_matrices",
+        list[File],
+        {
+            "help_string": "Design matrix of each run",
+            "mandatory": True,
+        },
+    ),
+    (
+        "specs",
+        list[dict],
+        {
+            "help_string": "spec of each run",
+            "mandatory": True,
+        },
+    ),
+    (
+        "smoothing_fwhm",
+        float,
+        {
+            "help_string": "Full-width half max (FWHM) in mm for smoothing in mask",
+        },
+    ),
+    (
+        "smoothing_type",
+        Literal["iso", "isoblurto"],
+        {
+            "help_string": "Type of smoothing (iso or isoblurto)'",
+        },
+    ),
+    (
+        "n_procs",
+        int,
+        {
+            "help_string": "Number of CPUs the estimator may use",
+        },
+    ),
+    (
+        "precision",
+        Literal["float32", "float64"],
+        {
+            "help_string": "Floating point precision of loaded data, model fits, contrasts "
+            "and output maps. If unset, data are held in float32 and models fit in float64",
+        },
+    ),
+    (
+        "prefetch_depth",
+        int,
+        {
+            "help_string": "Number of runs loaded in a background thread ahead of the runs "
+            "being fit. If unset, one run is loaded ahead; 0 loads runs only as they are fit",
+        },
+    ),
+]
+
+MultiRunFirstLevelEstimator_input_spec = SpecInfo(
+    name="MultiRunFirstLevelEstimatorInputSpec",
+    fields=MultiRunFirstLevelEstimator_input_fields,
+    bases=(BaseSpec,),
+)
+
+
+MultiRunEstimator_output_fields = [
+    (
+        "effect_maps",
+        list[list[File]],
+        {
+            "help_string": "effect maps of each run",
+        },
+    ),
+    (
+        "variance_maps",
+        list[list[File]],
+        {
+            "help_string": "variance maps of each run",
+        },
+    ),
+    (
+        "stat_maps",
+        list[list[File]],
+        {
+            "help_string": "stat maps of each run",
+        },
+    ),
+    (
+        "zscore_maps",
+        list[list[File]],
+        {
+            "help_string": "zscore maps of each run",
+        },
+    ),
+    (
+        "pvalue_maps",
+        list[list[File]],
+        {
+            "help_string": "pvalue maps of each run",
+        },
+    ),
+    (
+        "contrast_metadata",
+        list[list[dict]],
+        {
+            "help_string": "contrast metadata of each run",
+        },
+    ),
+    (
+        "model_maps",
+        list[list[File]],
+        {
+            "help_string": "model maps of each run",
+        },
+    ),
+    (
+        "model_metadata",
+        list[list[dict]],
+        {
+            "help_string": "model metadata of each run",
+        },
+    ),
+]
+
+MultiRunEstimator_output_spec = SpecInfo(
+    name="MultiRunEstimatorOutputSpec",
+    fields=MultiRunEstimator_output_fields,
+    bases=(BaseSpec,),
+)
+
+
+class MultiRunFirstLevelEstimatorInterface(FunctionTask):
+    input_spec = MultiRunFirstLevelEstimator_input_spec
+    output_spec = MultiRunEstimator_output_spec
@@ -4,8 +4,10 @@ import os
 import os.path as op
 import sys
 import xml.etree.ElementTree as ET
+from functools import partial
 from pathlib import Path
 
+import attr
 import nibabel as nb
 import numpy as np
 import pandas as pd
@@ -16,6 +18,11 @@ from pydra.engine.task import ShellCommandTask
 
 from nipype.interfaces.afni.base import Info
 
+from ..utils import get_n_procs, run_dag
+from ..utils.loading import load_data
+from ..utils.masks import compile_mask
+from ..utils.precision import get_precision
+from ..utils.smoothness import estimate_smoothness, write_smoothness
 from .nilearn import FirstLevelModel, _flatten, prepare_contrasts
 
 STAT_CODES = nb.volumeutils.Recoder(
@@ -62,11 +69,17 @@ class FirstLevelModel(FirstLevelModel):
         import nibabel as nb
         import pandas as pd
         import logging
-        from pydra.tasks.nipype1.utils import Nipype1Task
-        from nipype.interfaces import afni
 
         logger = logging.getLogger("pydra-fitlins.interface")
 
+        if self.inputs.compact_outputs is True:
+            raise NotImplementedError("Compact outputs are not available for the AFNI estimator.")
+        if self.inputs.container_outputs is True:
+            raise NotImplementedError("Map containers are not available for the AFNI estimator.")
+        if self.inputs.atlas not in [None, attr.NOTHING]:
+            raise NotImplementedError("Parcel models are not available for the AFNI estimator.")
+
+        precision = get_precision(self.inputs.precision)
         spec = self.inputs.spec
         mat = pd.read_csv(self.inputs.design_matrix, delimiter="\t", index_col=0)
         contrasts = prepare_contrasts(spec['contrasts'], mat.columns.tolist())
@@ -100,7 +113,8 @@ class FirstLevelModel(FirstLevelModel):
             (0, 1): None,
         }
         if signal_scaling:
-            img_mat = img.get_fdata()
+            # 3dREMLfit solves in its own precision; only the scaled input follows ours
+            img_mat = load_data(img, precision.data)
             mean = img_mat.mean(axis=axis_mapping[scaling_axis], keepdims=True)
             if (mean == 0).any():
                 logger.warning(
@@ -117,35 +131,19 @@ class FirstLevelModel(FirstLevelModel):
         # Execute commands
         logger.info(f"3dREMLfit and 3dPval computation will be performed in: {runtime.cwd}\n")
 
-        # Define 3dREMLfit command
-        remlfit = Nipype1Task(afni.Remlfit())
-        remlfit.inputs.in_files = img_path
-        remlfit.inputs.matrix = design_fname
-        remlfit.inputs.out_file = "glt_results.nii.gz"
-        remlfit.inputs.var_file = "glt_extra_variables.nii.gz"
-        remlfit.inputs.wherr_file = "wherrorts.nii.gz"
-        remlfit.inputs.errts_file = "errorts.nii.gz"
-        remlfit.inputs.rbeta_file = "rbetas.nii.gz"
-        remlfit.inputs.tout = True
-        remlfit.inputs.rout = True
-        remlfit.inputs.fout = True
-        remlfit.inputs.verb = True
-        remlfit.inputs.usetemp = True
-        remlfit.inputs.goforit = True
-        remlfit.inputs.mask = self.inputs.mask_file
-        reml_res = remlfit()
-
-        # calc smoothness
-        fwhm = Nipype1Task(afni.FWHMx())
-        fwhm.inputs.in_file = reml_res.outputs.wherr_file
-        fwhm.inputs.out_file = fname_fmt("model", "residsmoothness").replace('.nii.gz', '.tsv')
-        fwhm_res = fwhm()
-        fwhm_dat = pd.read_csv(fwhm_res.outputs.out_file, delim_whitespace=True, header=None)
-        fwhm_dat.to_csv(fwhm_res.outputs.out_file, index=None, header=False, sep='\t')
-
-        out_maps = nb.load(reml_res.outputs.out_file)
-        var_maps = nb.load(reml_res.outputs.var_file)
-        beta_maps = nb.load(reml_res.outputs.rbeta_file)
+        # With more than one CPU, fit independent slabs of the mask concurrently
+        n_procs = get_n_procs(self.inputs.n_procs)
+        if n_procs > 1:
+            reml_outputs, reml_imgs = remlfit_slabs(
+                img_path, design_fname, self.inputs.mask_file, n_procs, runtime.cwd
+            )
+        else:
+            reml_outputs = run_remlfit(img_path, design_fname, self.inputs.mask_file)
+            reml_imgs = {key: nb.load(fname) for key, fname in reml_outputs.items()}
+
+        out_maps = reml_imgs["out_file"]
+        var_maps = reml_imgs["var_file"]
+        beta_maps = reml_imgs["rbeta_file"]
 
         model_attr_extract = {
             'r_square': (out_maps, 0),
@@ -156,50 +154,50 @@ class FirstLevelModel(FirstLevelModel):
             'residwhstd': (var_maps, 3),
             'LjungBox': (var_maps, 5),
         }
-        # Save model level maps
-        model_maps = []
-        model_metadata = []
-        for attr, (imgs, idx) in model_attr_extract.items():
-            model_metadata.append({'stat': attr, **spec['entities']})
-            fname = fname_fmt('model', attr)
-            extract_volume(imgs, idx, f"{attr} of model", fname)
-            model_maps.append(fname)
-
-        # separate dict for maps that don't need to be extracted
-        model_attr = {
-            'residtsnr': self.save_tsnr(runtime, beta_maps, var_maps),
-            'residsmoothness': fwhm_res.outputs.out_file,
+
+        def _extract_model_map(stat, imgs, idx):
+            fname = fname_fmt('model', stat)
+            extract_volume(imgs, idx, f"{stat} of model", fname)
+            return fname
+
+        def _save_contrasts(pvals, zscores):
+            # create maps object
+            maps = {"stat": out_maps, "z_score": zscores, "p_value": pvals}
+            maps["effect_size"] = maps["stat"]
+            self.save_remlfit_results(maps, contrasts, runtime)
+
+        # The post-fit steps are independent, except for the contrast maps,
+        # which need the p-value and z-score buckets
+        steps = {
+            stat: (partial(_extract_model_map, stat, imgs, idx), [])
+            for stat, (imgs, idx) in model_attr_extract.items()
         }
+        steps['residtsnr'] = (partial(self.save_tsnr, runtime, beta_maps, var_maps), [])
+        steps['residsmoothness'] = (
+            partial(self.save_smoothness, runtime, reml_imgs["wherr_file"]),
+            [],
+        )
+        # get pvals and zscore buckets (niftis with heterogeneous intent codes)
+        steps['pvals'] = (partial(run_pval, reml_outputs["out_file"], "pval_maps.nii.gz"), [])
+        steps['zscores'] = (
+            partial(run_pval, reml_outputs["out_file"], "zscore_maps.nii.gz", zscore=True),
+            [],
+        )
+        steps['contrasts'] = (_save_contrasts, ['pvals', 'zscores'])
+        results = run_dag(steps, n_procs=n_procs)
+
+        # Save model level maps
+        model_stats = list(model_attr_extract) + ['residtsnr', 'residsmoothness']
+        model_maps = [results[stat] for stat in model_stats]
         # Save error time series if people want it
         if self.errorts:
-            model_attr["errorts"] = reml_res.outputs.wherr_file
-
-        for attr, fname in model_attr.items():
-            model_metadata.append({'stat': attr, **spec["entities"]})
-            model_maps.append(fname)
+            model_stats.append("errorts")
+            model_maps.append(reml_outputs["wherr_file"])
 
-        # get pvals and zscore buckets (niftis with heterogeneous intent codes)
-        pval = Pval()
-        pval.inputs.in_file = reml_res.outputs.out_file
-        pval.inputs.out_file = "pval_maps.nii.gz"
-        pvals = pval.run()
-
-        zscore = Pval()
-        zscore.inputs.in_file = reml_res.outputs.out_file
-        zscore.inputs.out_file = "zscore_maps.nii.gz"
-        zscore.inputs.zscore = True
-        zscores = zscore.run()
-
-        # create maps object
-        maps = {
-            "stat": out_maps,
-            "z_score": nb.load(zscores.outputs.out_file),
-            "p_value": nb.load(pvals.outputs.out_file),
-        }
-        maps["effect_size"] = maps["stat"]
-        self.save_remlfit_results(maps, contrasts, runtime)
         self._results['model_maps'] = model_maps
-        self._results['model_metadata'] = model_metadata
+        self._results['model_metadata'] = [
+            {'stat': stat, **spec['entities']} for stat in model_stats
+        ]
         #########################
         # Results are saved to self in save_remlfit_results, if the
         # memory saving is required it should be implemented there
@@ -274,48 +272,42 @@ class FirstLevelModel(FirstLevelModel):
             stat_idx = np.where(contrast_bool & stat_bool)[0]
             # For multirow ftests there will be more than one index
             effect_idx = np.where(contrast_bool & effect_bool)[0]
+            # Each effect row has a t statistic, which gives its variance
+            tstat_idx = np.where(contrast_bool & (stat_types == "T"))[0]
 
             # Append maps:
-            # for each index into the result objects stored in maps, apply a
-            # modifying function as required and then append it to the
-            # appropriate output list type represented by map_list and write
-            # map_list to disk
+            # for each index into the result objects stored in maps, extract
+            # the sub-bricks (one volume per row of multirow effects), write
+            # them to disk and append them to the appropriate output list
             for map_type, map_list, idx_list in (
                 ("effect_size", effect_maps, effect_idx),
                 ("z_score", zscore_maps, stat_idx),
                 ("p_value", pvalue_maps, stat_idx),
                 ("stat", stat_maps, stat_idx),
             ):
-
-                if len(effect_idx) > 1:
+                if not len(idx_list):
                     continue
-
-                # Extract maps and info from bucket and append to relevant
-                # list of maps
-                for idx in idx_list:
-                    imgs = maps[map_type]
-                    fname = fname_fmt(name, map_type)
-                    extract_volume(
-                        imgs, idx, f"{map_type} of contrast {name}", fname_fmt(name, map_type)
-                    )
-                    map_list.append(fname)
-
-        # calculate effect variance
-        for (name, weights, contrast_entities, contrast_type), effect_fname, stat_fname in zip(
-            contrasts, effect_maps, stat_maps
-        ):
-            map_type = "effect_variance"
-            effect_img = nb.load(effect_fname)
-            effect = effect_img.get_fdata()
-            stat_img = nb.load(stat_fname)
-            stat = stat_img.get_fdata()
-            variance = (effect / stat) ** 2
-            variance_img = nb.Nifti1Image(variance, effect_img.affine, effect_img.header)
-            variance_img.header['descrip'] = f"{map_type} of contrast {name}"
-
-            fname = fname_fmt(name, map_type)
-            variance_img.to_filename(fname)
-            variance_maps.append(fname)
+                fname = fname_fmt(name, map_type)
+                extract_volume(
+                    maps[map_type], idx_list, f"{map_type} of contrast {name}", fname
+                )
+                map_list.append(fname)
+
+            # calculate effect variance
+            if len(effect_idx) and len(tstat_idx) == len(effect_idx):
+                map_type = "effect_variance"
+                effect = _load_subbricks(maps["effect_size"], effect_idx)
+                tstat = _load_subbricks(maps["stat"], tstat_idx)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    variance = np.nan_to_num((effect / tstat) ** 2)
+                if variance.shape[-1] == 1:
+                    variance = variance[..., 0]
+                variance_img = nb.Nifti1Image(variance, maps["effect_size"].affine)
+                variance_img.header['descrip'] = f"{map_type} of contrast {name}"
+
+                fname = fname_fmt(name, map_type)
+                variance_img.to_filename(fname)
+                variance_maps.append(fname)
 
         self._results["effect_maps"] = effect_maps
         self._results["variance_maps"] = variance_maps
@@ -332,6 +324,16 @@ class FirstLevelModel(FirstLevelModel):
         )
         return list(set(conditions))
 
+    def save_smoothness(self, runtime, wherr_img):
+        # residuals are zero outside of the fit mask
+        wherr = wherr_img.get_fdata(dtype='f4')
+        resid_mask = (wherr != 0).any(axis=-1)
+        fwhm, acf = estimate_smoothness(
+            wherr[resid_mask].T, resid_mask, wherr_img.header.get_zooms()[:3]
+        )
+        fname = op.join(runtime.cwd, 'model_residsmoothness.tsv')
+        return write_smoothness(fname, fwhm, acf)
+
     def save_tsnr(self, runtime, rbetas, rvars):
         vol_labels = parse_afni_ext(rbetas)["BRICK_LABS"].split("~")
         mat = pd.read_csv(self.inputs.design_matrix, delimiter="\t", index_col=0)
@@ -341,9 +343,10 @@ class FirstLevelModel(FirstLevelModel):
         else:
             const_name = mat.columns[np.isclose(mat, 1).all(0)].values[0]
         const_idx = np.where(np.array(vol_labels) == const_name)[0]
-        const_dat = rbetas.slicer[..., int(const_idx)].get_fdata()
+        dtype = get_precision(self.inputs.precision).data
+        const_dat = rbetas.slicer[..., int(const_idx)].get_fdata(dtype=dtype)
         std_img = rvars.slicer[..., 3]
-        std_dat = std_img.get_fdata()
+        std_dat = std_img.get_fdata(dtype=dtype)
         # scaled units are percent signal change
         # afni convention is mean of 100
         # nistat convention is mean of 0
@@ -356,10 +359,151 @@ class FirstLevelModel(FirstLevelModel):
         return fname
 
 
+REMLFIT_OUTPUTS = {
+    "out_file": "glt_results.nii.gz",
+    "var_file": "glt_extra_variables.nii.gz",
+    "rbeta_file": "rbetas.nii.gz",
+    "wherr_file": "wherrorts.nii.gz",
+}
+
+
+def run_remlfit(in_file, matrix, mask_file=None, prefix="", errts=True, num_threads=None):
+    """Run 3dREMLfit, returning a dictionary of output bucket filenames
+    Outputs are named after ``REMLFIT_OUTPUTS``, with an optional ``prefix``
+    that may include a directory. This is a module-level function so that it
+    can be dispatched to worker processes.
+    """
+    from pydra.tasks.nipype1.utils import Nipype1Task
+    from nipype.interfaces import afni
+
+    remlfit = Nipype1Task(afni.Remlfit())
+    remlfit.inputs.in_files = in_file
+    remlfit.inputs.matrix = matrix
+    for key, fname in REMLFIT_OUTPUTS.items():
+        setattr(remlfit.inputs, key, prefix + fname)
+    if errts:
+        remlfit.inputs.errts_file = prefix + "errorts.nii.gz"
+    remlfit.inputs.tout = True
+    remlfit.inputs.rout = True
+    remlfit.inputs.fout = True
+    remlfit.inputs.verb = True
+    remlfit.inputs.usetemp = True
+    remlfit.inputs.goforit = True
+    if mask_file not in [None, attr.NOTHING]:
+        remlfit.inputs.mask = mask_file
+    if num_threads is not None:
+        remlfit.inputs.num_threads = num_threads
+    reml_res = remlfit()
+
+    return {key: getattr(reml_res.outputs, key) for key in REMLFIT_OUTPUTS}
+
+
+def remlfit_slabs(in_file, matrix, mask_file, n_slabs, out_dir):
+    """Fit 3dREMLfit on axial slabs of the mask in parallel and merge the results
+    The mask (or the full field of view, if no mask is given) is split into
+    at most ``n_slabs`` slabs with balanced voxel counts. Each slab is fit by a
+    single-threaded 3dREMLfit in a local process pool, and the output buckets
+    are reassembled into whole-brain images that retain the AFNI header
+    extensions of the first slab.
+    Returns the merged filenames and the merged in-memory images, keyed as
+    in ``REMLFIT_OUTPUTS``.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    bold_img = nb.load(in_file)
+    if mask_file in [None, attr.NOTHING]:
+        mask = np.ones(bold_img.shape[:3], dtype=bool)
+    else:
+        mask = compile_mask(mask_file, bold_img).mask
+    slabs = mask_slabs(mask, n_slabs)
+
+    jobs = []
+    for ii, (start, stop) in enumerate(slabs):
+        slab_mask = np.zeros_like(mask)
+        slab_mask[..., start:stop] = mask[..., start:stop]
+        slab_mask_file = op.join(out_dir, f"mask_slab-{ii}.nii.gz")
+        nb.Nifti1Image(slab_mask.astype(np.uint8), bold_img.affine).to_filename(slab_mask_file)
+        prefix = op.join(out_dir, f"slab-{ii}_")
+        jobs.append((in_file, matrix, slab_mask_file, prefix, False, 1))
+
+    with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+        slab_outputs = list(pool.map(_run_remlfit_job, jobs))
+
+    merged = {}
+    merged_imgs = {}
+    for key, fname in REMLFIT_OUTPUTS.items():
+        merged[key] = op.join(out_dir, fname)
+        merged_imgs[key] = merge_slabs(
+            [outputs[key] for outputs in slab_outputs], slabs, merged[key]
+        )
+    return merged, merged_imgs
+
+
+def _run_remlfit_job(args):
+    return run_remlfit(*args)
+
+
+def mask_slabs(mask, n_slabs):
+    """Split a 3D mask into at most ``n_slabs`` axial slabs of similar voxel count
+    Returns a list of ``(start, stop)`` bounds along the last axis. Slabs that
+    contain no mask voxels are dropped.
+    Examples
+    --------
+    >>> mask = np.ones((2, 2, 10), dtype=bool)
+    >>> mask_slabs(mask, 3)
+    [(0, 4), (4, 7), (7, 10)]
+    >>> mask[..., 5:] = False
+    >>> mask_slabs(mask, 8)
+    [(0, 1), (1, 2), (2, 3), (3, 4), (4, 10)]
+    """
+    counts = np.cumsum(mask.reshape(-1, mask.shape[-1]).sum(axis=0))
+    targets = counts[-1] * np.arange(1, n_slabs) / n_slabs
+    cuts = np.searchsorted(counts, targets, side="left") + 1
+    bounds = np.unique(np.concatenate(([0], cuts, [mask.shape[-1]])))
+    slabs = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        # Extend previous slab over empty slices
+        if slabs and not mask[..., start:stop].any():
+            slabs[-1] = (slabs[-1][0], int(stop))
+        else:
+            slabs.append((int(start), int(stop)))
+    return slabs
+
+
+def merge_slabs(slab_files, slabs, out_file):
+    """Merge per-slab 3dREMLfit buckets into a single image
+    Each slab file only has nonzero values within its bounds along the last
+    spatial axis, so only those slices are read from each file. The merged
+    image is written to ``out_file`` and returned.
+    """
+    ref_img = nb.load(slab_files[0])
+    data = np.zeros(ref_img.shape, dtype=np.float32)
+    for fname, (start, stop) in zip(slab_files, slabs):
+        img = ref_img if fname == slab_files[0] else nb.load(fname)
+        data[:, :, start:stop] = img.dataobj[:, :, start:stop]
+    out_img = nb.Nifti1Image(data, ref_img.affine, ref_img.header)
+    out_img.to_filename(out_file)
+    return out_img
+
+
+def _load_subbricks(imgs, indices):
+    return np.stack(
+        [imgs.slicer[..., int(idx)].get_fdata(dtype=np.float32) for idx in indices], axis=-1
+    )
+
+
 def extract_volume(imgs, idx, intent_name, fname):
-    img = imgs.slicer[..., int(idx)]
-    intent_info = get_afni_intent_info_for_subvol(imgs, idx)
-    outmap = nb.Nifti1Image.from_image(img)
+    """Write a sub-brick of a bucket to ``fname``
+    If ``idx`` is a sequence of several indices, such as the coefficients of
+    a multirow F-test, the sub-bricks are written as a 4D image with the
+    intent of the first sub-brick.
+    """
+    indices = np.atleast_1d(idx)
+    intent_info = get_afni_intent_info_for_subvol(imgs, int(indices[0]))
+    if len(indices) == 1:
+        outmap = nb.Nifti1Image.from_image(imgs.slicer[..., int(indices[0])])
+    else:
+        outmap = nb.Nifti1Image(_load_subbricks(imgs, indices), imgs.affine)
     outmap = set_intents([outmap], [intent_info])[0]
     outmap.header['descrip'] = intent_name
     outmap.to_filename(fname)
@@ -618,6 +762,16 @@ class Pval(ShellCommandTask):
             return self._gen_fname(self.inputs.in_file, suffix="_pval")
 
 
+def run_pval(in_file, out_file, zscore=False):
+    """Run 3dPval on a bucket, returning the loaded output bucket"""
+    pval = Pval()
+    pval.inputs.in_file = in_file
+    pval.inputs.out_file = out_file
+    if zscore:
+        pval.inputs.zscore = True
+    return nb.load(pval.run().outputs.out_file)
+
+
 def parse_afni_ext(nifti_file):
 
     afni_extension = None
@@ -0,0 +1,477 @@
+"""Native ARMA(1,1) REML estimator
+A NumPy implementation of the first-level model fit by AFNI's 3dREMLfit.
+The serial correlation of each voxel is modeled as an ARMA(1,1) process, whose
+parameters are chosen per voxel by a grid search over the restricted maximum
+likelihood (REML). Whitening matrices are cached per grid cell and voxels are
+solved in batches, so the fit runs in-process without any subprocess calls or
+intermediate files.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import attr
+import numpy as np
+import pandas as pd
+
+from pydra.engine.task import FunctionTask
+
+from ..utils import get_n_procs
+from ..utils.glm import contrast_stats, design_cache
+from ..utils.images import MapWriter
+from ..utils.loading import load_data
+from ..utils.masks import COMPACT_EXTENSION, CompiledMask, compact_img, compile_mask
+from ..utils.parcels import ParcelMap, compile_atlas
+from ..utils.precision import get_precision
+from ..utils.smoothing import smooth_in_mask
+from ..utils.smoothness import estimate_smoothness, write_smoothness
+from .abstract import FirstLevelEstimatorInterface
+from .nilearn import dscalar_from_cifti, prepare_contrasts
+
+# Number of voxels solved per batch
+CHUNK_SIZE = 10000
+
+
+def arma_lambda(a, b):
+    """Lag-1 autocorrelation of an ARMA(1,1) process
+    Examples
+    --------
+    >>> float(arma_lambda(0.5, 0.0))
+    0.5
+    >>> float(arma_lambda(0.0, 0.0))
+    0.0
+    """
+    return (b + a) * (1 + a * b) / (1 + 2 * a * b + b * b)
+
+
+def arma_grid(max_a=0.8, max_b=0.8, grid_power=3):
+    """Grid of ARMA(1,1) parameters searched by the REML fit
+    Following 3dREMLfit, ``a`` ranges over ``0 .. max_a`` and ``b`` over
+    ``-max_b .. max_b``, with ``2 ** grid_power`` divisions per unit range of
+    each parameter. Cells that do not produce a valid correlation
+    (``|lambda| >= 1``) are excluded.
+    Examples
+    --------
+    >>> grid = arma_grid()
+    >>> grid[0]
+    (0.0, -0.8)
+    >>> (0.0, 0.0) in grid
+    True
+    """
+    n_div = 2 ** grid_power
+    a_vals = np.linspace(0, max_a, n_div + 1)
+    b_vals = np.linspace(-max_b, max_b, 2 * n_div + 1)
+    return [
+        (round(float(a), 6), round(float(b), 6))
+        for a in a_vals
+        for b in b_vals
+        if abs(arma_lambda(a, b)) < 1
+    ]
+
+
+@lru_cache(maxsize=256)
+def arma_whitener(a, b, n_vols):
+    """Inverse Cholesky factor of an ARMA(1,1) correlation matrix
+    Returns the whitening matrix ``W`` such that ``W @ R @ W.T`` is the
+    identity, and ``log(det(R))``. Results are cached, as the matrix only
+    depends on the grid cell and the number of volumes, and are read-only.
+    """
+    from scipy.linalg import cholesky, solve_triangular, toeplitz
+
+    corr = np.zeros(n_vols)
+    corr[0] = 1
+    corr[1:] = arma_lambda(a, b) * a ** np.arange(n_vols - 1)
+    chol = cholesky(toeplitz(corr), lower=True)
+    whitener = solve_triangular(chol, np.eye(n_vols), lower=True)
+    whitener.setflags(write=False)
+    return whitener, 2 * np.log(np.diag(chol)).sum()
+
+
+class _WhitenedDesign:
+    """Design matrix whitened for a single ARMA(1,1) grid cell
+    Decompositions are looked up in the shared design cache, so runs with
+    identical designs only decompose each whitened design once.
+    """
+
+    def __init__(self, design, a, b):
+        self.whitener, self.logdet_corr = arma_whitener(a, b, design.shape[0])
+        self.design = self.whitener @ design
+        info = design_cache.design(self.design)
+        self.rank = info.rank
+        self.logdet_xtx = info.logdet_xtx
+        self.pinv = info.pinv
+        self.cov = info.cov
+        self.basis = info.basis
+
+
+def ljung_box(resid, n_lags=None):
+    """Ljung-Box statistic for each column of a residual matrix
+    By default, ``min(10, n_vols // 5)`` lags are used.
+    """
+    n_vols = resid.shape[0]
+    if n_lags is None:
+        n_lags = max(1, min(10, n_vols // 5))
+    denom = (resid ** 2).sum(axis=0)
+    denom[denom == 0] = 1
+    stat = np.zeros(resid.shape[1])
+    for lag in range(1, n_lags + 1):
+        acf = (resid[lag:] * resid[:-lag]).sum(axis=0) / denom
+        stat += acf ** 2 / (n_vols - lag)
+    return n_vols * (n_vols + 2) * stat
+
+
+def _chunks(n_vox, chunk_size=CHUNK_SIZE):
+    return [slice(start, min(start + chunk_size, n_vox)) for start in range(0, n_vox, chunk_size)]
+
+
+def fit_arma(
+    data, design, contrasts, n_procs=1, grid=None, chunk_size=CHUNK_SIZE, precision=None
+):
+    """Fit an ARMA(1,1) GLM by REML to a (time x voxels) data matrix
+    Parameters
+    ----------
+    data : (n_vols, n_voxels) array
+        Signal-scaled time series
+    design : (n_vols, n_regressors) array
+        Design matrix
+    contrasts : list
+        Output of ``prepare_contrasts``
+    n_procs : int
+        Number of threads used to solve voxel batches
+    grid : list of (a, b) tuples
+        Grid of ARMA parameters to search (default: ``arma_grid()``)
+    precision : str
+        ``'float32'`` or ``'float64'`` (see ``get_precision``). By default,
+        voxels are solved in float64 and maps are returned in float32
+    Returns
+    -------
+    model_maps : dict
+        Voxelwise model statistics keyed by map name
+    contrast_maps : list of dict
+        Effect, variance, statistic, z-score and p-value arrays per contrast
+    betas : (n_regressors, n_voxels) array
+        Parameter estimates
+    resid : (n_vols, n_voxels) array
+        Whitened residuals
+    Examples
+    --------
+    >>> rng = np.random.default_rng(0)
+    >>> design = np.column_stack([np.sin(np.arange(100) / 5), np.ones(100)])
+    >>> noise = rng.normal(size=(100, 200))
+    >>> noise[1:] += 0.4 * noise[:-1]
+    >>> data = 0.5 * design[:, :1] + noise
+    >>> contrasts = [('task', np.array([[1.0, 0.0]]), {}, 't')]
+    >>> fits = {
+    ...     precision: fit_arma(data, design, contrasts, precision=precision)
+    ...     for precision in ('float32', 'float64')
+    ... }
+    >>> fits['float32'][1][0]['z_score'].dtype
+    dtype('float32')
+    >>> z_scores = [fits[precision][1][0]['z_score'] for precision in ('float32', 'float64')]
+    >>> bool(np.abs(z_scores[0] - z_scores[1]).max() < 1e-3)
+    True
+    """
+    if grid is None:
+        grid = arma_grid()
+    precision = get_precision(precision)
+    solve_dtype, out_dtype = precision.solve, precision.data
+    design = np.asarray(design, dtype=np.float64)
+    n_vols, n_vox = data.shape
+    chunks = _chunks(n_vox, chunk_size)
+    # Hold the whitened design of every cell and its projection for every contrast
+    design_cache.reserve(len(grid), len(grid) * len(contrasts))
+
+    # REML criterion over the grid, keeping the best cell per voxel
+    best_crit = np.full(n_vox, -np.inf)
+    best_cell = np.zeros(n_vox, dtype=np.intp)
+    with ThreadPoolExecutor(max_workers=n_procs) as executor:
+        for cell, (a, b) in enumerate(grid):
+            wdesign = _WhitenedDesign(design, a, b)
+            # Whitened residuals, rather than a quadratic form of the data, keep
+            # the residual sum of squares accurate in float32
+            whitener = wdesign.whitener.astype(solve_dtype)
+            basis = wdesign.basis.astype(solve_dtype)
+            dof = n_vols - wdesign.rank
+            const = wdesign.logdet_corr + wdesign.logdet_xtx
+
+            def _search(chunk):
+                wdata = whitener @ data[:, chunk].astype(solve_dtype)
+                wresid = wdata - basis @ (basis.T @ wdata)
+                rss = np.einsum('ij,ij->j', wresid, wresid)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    crit = -0.5 * (dof * np.log(rss) + const)
+                better = crit > best_crit[chunk]
+                best_crit[chunk][better] = crit[better]
+                best_cell[chunk][better] = cell
+
+            list(executor.map(_search, chunks))
+
+        # Final estimates, solving together all voxels that share a cell
+        n_regs = design.shape[1]
+        betas = np.zeros((n_regs, n_vox), dtype=out_dtype)
+        resid = np.zeros((n_vols, n_vox), dtype=out_dtype)
+        model_maps = {
+            key: np.zeros(n_vox, dtype=out_dtype)
+            for key in ('r_square', 'log_likelihood', 'a', 'b', 'lam', 'residwhstd', 'LjungBox')
+        }
+        contrast_maps = []
+        for _, weights, _, test in contrasts:
+            n_rows = 1 if test.lower() == 't' else weights.shape[0]
+            contrast_maps.append(
+                {
+                    'effect_size': np.zeros((n_rows, n_vox), dtype=out_dtype),
+                    'effect_variance': np.zeros((1, n_vox), dtype=out_dtype),
+                    'stat': np.zeros(n_vox, dtype=out_dtype),
+                    'z_score': np.zeros(n_vox, dtype=out_dtype),
+                    'p_value': np.ones(n_vox, dtype=out_dtype),
+                }
+            )
+
+        for cell in np.unique(best_cell):
+            a, b = grid[cell]
+            wdesign = _WhitenedDesign(design, a, b)
+            dof = n_vols - wdesign.rank
+            whitener = wdesign.whitener.astype(solve_dtype)
+            wpinv = wdesign.pinv.astype(solve_dtype)
+            wdesign_matrix = wdesign.design.astype(solve_dtype)
+            cell_vox = np.flatnonzero(best_cell == cell)
+            projections = [
+                (weights, design_cache.projection(wdesign.design, weights))
+                for _, weights, _, _ in contrasts
+            ]
+
+            def _solve(chunk):
+                idx = cell_vox[chunk]
+                wdata = whitener @ data[:, idx].astype(solve_dtype)
+                beta = wpinv @ wdata
+                wresid = wdata - wdesign_matrix @ beta
+                rss = (wresid ** 2).sum(axis=0)
+                sigma2 = rss / dof
+                tss = ((wdata - wdata.mean(axis=0)) ** 2).sum(axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    model_maps['r_square'][idx] = np.where(tss > 0, 1 - rss / tss, 0)
+                    model_maps['log_likelihood'][idx] = -0.5 * (
+                        wdesign.logdet_corr
+                        + wdesign.logdet_xtx
+                        + dof * (np.log(2 * np.pi * sigma2) + 1)
+                    )
+                model_maps['residwhstd'][idx] = np.sqrt(sigma2)
+                model_maps['LjungBox'][idx] = ljung_box(wresid)
+                betas[:, idx] = beta
+                resid[:, idx] = wresid
+
+                for (weights, proj), (_, _, _, test), maps in zip(
+                    projections, contrasts, contrast_maps
+                ):
+                    values = contrast_stats(weights @ beta, proj, sigma2, dof, test)
+                    for map_type, map_data in maps.items():
+                        map_data[..., idx] = values[map_type]
+
+            list(executor.map(_solve, _chunks(len(cell_vox), chunk_size)))
+            model_maps['a'][cell_vox] = a
+            model_maps['b'][cell_vox] = b
+            model_maps['lam'][cell_vox] = arma_lambda(a, b)
+
+    return model_maps, contrast_maps, betas, resid
+
+
+class FirstLevelModel(FirstLevelEstimatorInterface, FunctionTask):
+    def __init__(self, errorts=False, *args, **kwargs):
+        super(FirstLevelModel, self).__init__(*args, **kwargs)
+        self.errorts = errorts
+
+    def _run_interface(self, runtime):
+        """
+        Fit a GLM with ARMA(1,1) noise by REML, matching AFNI's 3dREMLfit
+        """
+        import nibabel as nb
+
+        spec = self.inputs.spec
+        mat = pd.read_csv(self.inputs.design_matrix, delimiter='\t', index_col=0)
+        contrasts = prepare_contrasts(spec['contrasts'], mat.columns.tolist())
+        img = nb.load(self.inputs.bold_file)
+
+        n_procs = get_n_procs(self.inputs.n_procs)
+        precision = get_precision(self.inputs.precision)
+        smoothing_fwhm = self.inputs.smoothing_fwhm
+        if smoothing_fwhm in [None, attr.NOTHING]:
+            smoothing_fwhm = None
+        smoothing_type = self.inputs.smoothing_type
+        if smoothing_type in [None, attr.NOTHING]:
+            smoothing_type = 'iso'
+
+        is_cifti = isinstance(img, nb.Cifti2Image)
+        compact_outputs = self.inputs.compact_outputs is True and not is_cifti
+        is_parcels = self.inputs.atlas not in [None, attr.NOTHING]
+        if smoothing_fwhm is not None and (is_cifti or is_parcels):
+            raise NotImplementedError(
+                "Smoothing is only available for NIfTI voxelwise ARMA models."
+            )
+        if is_parcels:
+            if is_cifti:
+                raise ValueError("Parcel models require a NIfTI series")
+            if compact_outputs or self.inputs.container_outputs is True:
+                raise ValueError("Parcel models write tables, not compact or container outputs")
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.tsv').format
+            mask_file = self.inputs.mask_file
+            atlas = compile_atlas(
+                self.inputs.atlas,
+                img,
+                None if mask_file in [None, attr.NOTHING] else compile_mask(mask_file, img),
+            )
+            data = atlas.means(img, dtype=precision.data)
+            mask = np.ones(atlas.n_parcels, dtype=bool)
+        elif is_cifti:
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.dscalar.nii').format
+            data = load_data(img, precision.data)
+            mask = np.ones(data.shape[1], dtype=bool)
+        else:
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.nii.gz').format
+            mask_file = self.inputs.mask_file
+            if mask_file in [None, attr.NOTHING]:
+                if compact_outputs:
+                    raise ValueError("Compact outputs require a mask file")
+                mask = CompiledMask(np.ones(img.shape[:3], dtype=bool), img.affine)
+            else:
+                mask = compile_mask(mask_file, img)
+            data = mask.apply(img, dtype=precision.data)
+            if smoothing_fwhm is not None:
+                data = smooth_in_mask(
+                    data, mask, smoothing_fwhm, smoothing_type, n_procs, dtype=precision.data
+                )
+
+        # Exclude constant voxels, which have no defined REML criterion
+        valid = data.std(axis=0) > 0
+        if is_cifti or is_parcels:
+            mask[mask] = valid
+        else:
+            brain_mask = mask
+            mask = mask.restrict(valid)
+        data = data[:, valid]
+
+        # Scale to percent signal change, following the AFNI estimator
+        mean = np.maximum(data.mean(axis=0), 1)
+        data = 100 * (data / mean - 1)
+
+        model_vals, contrast_vals, betas, resid = fit_arma(
+            data,
+            mat.values,
+            contrasts,
+            n_procs=n_procs,
+            precision=self.inputs.precision,
+        )
+
+        def to_img(values, name):
+            values = np.atleast_2d(values).astype(precision.data)
+            n_maps = values.shape[0]
+            if is_cifti or is_parcels:
+                full = np.zeros((n_maps,) + mask.shape, dtype=precision.data)
+                full[:, mask] = values
+                names = [name] if n_maps == 1 else [f"{name} {ii}" for ii in range(n_maps)]
+                if is_parcels:
+                    return ParcelMap(atlas.labels, full, names)
+                return dscalar_from_cifti(img, full, names)
+            out = mask.unmask(values[0] if n_maps == 1 else values)
+            out.header['descrip'] = name
+            return out
+
+        def to_compact(values, name):
+            values = np.atleast_2d(values).astype(precision.data)
+            full = np.zeros((len(values), brain_mask.n_voxels), dtype=precision.data)
+            full[:, valid] = values
+            out = compact_img(
+                full[0] if len(full) == 1 else full, mask_file, brain_mask, precision.data
+            )
+            out.header['descrip'] = name
+            return out
+
+        # residual TSNR, relative to an AFNI-style mean of 100
+        if 'constant' in mat.columns:
+            const_idx = mat.columns.get_loc('constant')
+        else:
+            const_idx = np.flatnonzero(np.isclose(mat, 1).all(0))[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            model_vals['residtsnr'] = np.nan_to_num(
+                np.abs(betas[const_idx] + 100) / model_vals['residwhstd']
+            )
+
+        if self.inputs.container_outputs is not True:
+            writer = MapWriter()
+        elif is_cifti:
+            writer = MapWriter(
+                os.path.join(runtime.cwd, 'maps.dscalar.nii'), dtype=precision.data
+            )
+        elif compact_outputs:
+            writer = MapWriter(
+                os.path.join(runtime.cwd, 'maps' + COMPACT_EXTENSION),
+                mask_file,
+                brain_mask,
+                dtype=precision.data,
+            )
+        else:
+            writer = MapWriter(os.path.join(runtime.cwd, 'maps.nii.gz'), dtype=precision.data)
+
+        model_maps = []
+        model_metadata = []
+        for stat, values in model_vals.items():
+            model_metadata.append({'stat': stat, **spec['entities']})
+            fname = fname_fmt('model', stat)
+            out = to_img(values, f"{stat} of model")
+            model_maps.append(writer.save(out, fname, f'model_{stat}'))
+        # Residual smoothness is only defined on a voxel grid
+        if not (is_cifti or is_parcels):
+            fwhm, acf = estimate_smoothness(resid, mask.mask, img.header.get_zooms()[:3])
+            fname = fname_fmt('model', 'residsmoothness').replace('.nii.gz', '.tsv')
+            model_metadata.append({'stat': 'residsmoothness', **spec['entities']})
+            model_maps.append(write_smoothness(fname, fwhm, acf))
+        # Save error time series if people want it
+        if self.errorts:
+            model_metadata.append({'stat': 'errorts', **spec['entities']})
+            fname = fname_fmt('model', 'errorts')
+            to_img(resid, "errorts of model").to_filename(fname)
+            model_maps.append(fname)
+
+        effect_maps = []
+        variance_maps = []
+        stat_maps = []
+        zscore_maps = []
+        pvalue_maps = []
+        contrast_metadata = []
+        for (name, weights, cont_ents, contrast_test), maps in zip(contrasts, contrast_vals):
+            contrast_metadata.append(
+                {
+                    "name": spec['name'],
+                    "level": spec['level'],
+                    "stat": contrast_test,
+                    **cont_ents,
+                }
+            )
+            for map_type, map_list in (
+                ('effect_size', effect_maps),
+                ('effect_variance', variance_maps),
+                ('z_score', zscore_maps),
+                ('p_value', pvalue_maps),
+                ('stat', stat_maps),
+            ):
+                fname = fname_fmt(name, map_type)
+                if compact_outputs:
+                    fname = fname.replace('.nii.gz', COMPACT_EXTENSION)
+                    out = to_compact(maps[map_type], f"{map_type} of contrast {name}")
+                else:
+                    out = to_img(maps[map_type], f"{map_type} of contrast {name}")
+                map_list.append(writer.save(out, fname, f'{name}_{map_type}'))
+
+        writer.close()
+        if writer.container is not None:
+            self._results['map_container'] = writer.container
+
+        self._results['effect_maps'] = effect_maps
+        self._results['variance_maps'] = variance_maps
+        self._results['stat_maps'] = stat_maps
+        self._results['zscore_maps'] = zscore_maps
+        self._results['pvalue_maps'] = pvalue_maps
+        self._results['contrast_metadata'] = contrast_metadata
+        self._results['model_maps'] = model_maps
+        self._results['model_metadata'] = model_metadata
+
+        return runtime
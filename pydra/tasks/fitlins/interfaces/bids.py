@@ -24,6 +24,8 @@ from pydra.engine.task import FunctionTask
 from nipype.interfaces.io import IOBase
 
 from ..utils import snake_to_camel, to_alphanum
+from ..utils.images import load_map, split_map_ref
+from ..utils.masks import COMPACT_EXTENSION, expand_compact, is_compact
 
 iflogger = logging.getLogger('pydra-fitlins.interface')
 
@@ -61,6 +63,7 @@ def bids_split_filename(fname):
         ".func.gii",
         ".dtseries.nii",
         ".dscalar.nii",
+        COMPACT_EXTENSION,
         ".nii.gz",
         ".tsv.gz",
     ]
@@ -533,9 +536,20 @@ class BIDSSelect(FunctionTask):
 
 
 def _copy_or_convert(in_file, out_file):
-    in_ext = bids_split_filename(in_file)[2]
+    in_path, map_index = split_map_ref(in_file)
+    in_ext = bids_split_filename(in_path)[2]
     out_ext = bids_split_filename(out_file)[2]
 
+    # Compact in-mask images are intermediates; expand them to full volumes
+    if is_compact(in_path):
+        expand_compact(load_map(in_file)).to_filename(out_file)
+        return
+
+    # Maps of a container are read on their own
+    if map_index is not None:
+        load_map(in_file).to_filename(out_file)
+        return
+
     # Copy if filename matches
     if in_ext == out_ext:
         copyfile(in_file, out_file, copy=True, use_hardlink=True)
@@ -621,7 +635,7 @@ class BIDSDataSink(IOBase):
     output_spec = BIDSDataSink_output_spec
 
     _always_run = True
-    _extension_map = {".nii": ".nii.gz"}
+    _extension_map = {".nii": ".nii.gz", COMPACT_EXTENSION: ".nii.gz"}
 
     def _list_outputs(self):
         from bids.layout import BIDSLayout
@@ -639,7 +653,7 @@ class BIDSDataSink(IOBase):
         for entities, in_file in zip(self.inputs.entities, self.inputs.in_file):
             ents = {**self.inputs.fixed_entities}
             ents.update(entities)
-            ext = bids_split_filename(in_file)[2]
+            ext = bids_split_filename(split_map_ref(in_file)[0])[2]
             ents['extension'] = self._extension_map.get(ext, ext)
 
             # In some instances, name/contrast could have the following
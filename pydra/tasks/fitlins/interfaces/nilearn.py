@@ -1,4 +1,4 @@
-import os, attr
+import os, attr, json
 import numpy as np
 import pandas as pd
 from functools import partial
@@ -7,9 +7,43 @@ from functools import partial
 from nipype.interfaces.base import LibraryBaseInterface
 from pydra.engine.task import FunctionTask
 
+from ..utils import get_n_procs, prefetch
+from ..utils.glm import (
+    DesignCache,
+    MixedEffectsResults,
+    SufficientStats,
+    fit_mixed_effects,
+    permutation_test,
+)
+from ..utils.images import (
+    MapWriter,
+    check_compatible,
+    dscalar_factory,
+    iter_blocks,
+    iter_stacked,
+    load_map,
+    load_stacked,
+    split_map_ref,
+    stacked_to_img,
+)
+from ..utils.loading import load_data
+from ..utils.masks import (
+    COMPACT_EXTENSION,
+    CompiledMask,
+    compact_img,
+    compact_mask,
+    compact_reference,
+    compile_mask,
+)
+from ..utils.parcels import ParcelMap, compile_atlas, load_parcel_maps
+from ..utils.precision import cast_results, get_precision
+from ..utils.smoothing import smooth_in_mask
+from ..utils.smoothness import estimate_smoothness, write_smoothness
 from .abstract import (
+    BatchSecondLevelEstimatorInterface,
     DesignMatrixInterface,
     FirstLevelEstimatorInterface,
+    MultiRunFirstLevelEstimatorInterface,
     SecondLevelEstimatorInterface,
 )
 
@@ -67,6 +101,17 @@ def _get_voxelwise_stat(labels, results, stat):
     return voxelwise_attribute
 
 
+def _get_voxelwise_residuals(labels, results):
+    n_vols = next(iter(results.values())).whitened_residuals.shape[0]
+    residuals = np.zeros((n_vols, len(labels)), dtype=np.float32)
+
+    for label_ in results:
+        label_mask = labels == label_
+        residuals[:, label_mask] = results[label_].whitened_residuals
+
+    return residuals
+
+
 class DesignMatrix(NilearnBaseInterface, DesignMatrixInterface, FunctionTask):
     def _run_interface(self, runtime):
         import nibabel as nb
@@ -135,27 +180,44 @@ class DesignMatrix(NilearnBaseInterface, DesignMatrixInterface, FunctionTask):
 
 
 def dscalar_from_cifti(img, data, name):
-    import numpy as np
+    """dscalar CIFTI-2 image of ``data`` named ``name``, on the brain models of ``img``
+    Headers are built by the ``DscalarFactory`` cached for ``img``, so the
+    brain models of a source image are only converted once for all its maps.
+    """
+    return dscalar_factory(img)(data, name)
+
+
+def func_from_gifti(img, data, name):
+    """GIFTI image of per-vertex ``data`` named ``name``, on the surface of ``img``
+    Multi-row maps, such as the effects of F contrasts, are written as one
+    data array per row, each with the same intent and name.
+    Examples
+    --------
+    >>> import nibabel as nb, tempfile
+    >>> surf = nb.GiftiImage(darrays=[nb.gifti.GiftiDataArray(np.zeros(50, 'f4'))])
+    >>> surf.meta['AnatomicalStructurePrimary'] = 'CortexLeft'
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'effect_size.func.gii')
+    >>> func_from_gifti(surf, np.arange(100, dtype='f4').reshape(2, 50), 'F').to_filename(fname)
+    >>> loaded = nb.load(fname)
+    >>> [darray.data.shape for darray in loaded.darrays]
+    [(50,), (50,)]
+    >>> float(loaded.darrays[1].data[0]), loaded.darrays[1].meta['Name']
+    (50.0, 'F')
+    >>> loaded.meta['AnatomicalStructurePrimary']
+    'CortexLeft'
+    """
     import nibabel as nb
 
-    # Clear old CIFTI-2 extensions from NIfTI header and set intent
-    nifti_header = img.nifti_header.copy()
-    nifti_header.extensions.clear()
-    nifti_header.set_intent('ConnDenseScalar')
-
-    # Create CIFTI-2 header
-    scalar_axis = nb.cifti2.ScalarAxis(np.atleast_1d(name))
-    axes = [nb.cifti2.cifti2_axes.from_index_mapping(mim) for mim in img.header.matrix]
-    if len(axes) != 2:
-        raise ValueError(f"Can't generate dscalar CIFTI-2 from header with axes {axes}")
-    header = nb.cifti2.cifti2_axes.to_header(
-        axis if isinstance(axis, nb.cifti2.BrainModelAxis) else scalar_axis for axis in axes
-    )
-
-    new_img = nb.Cifti2Image(
-        data.reshape(header.matrix.get_data_shape()), header=header, nifti_header=nifti_header
+    meta = nb.gifti.GiftiMetaData(
+        {key: value for key, value in img.meta.items() if key.startswith('AnatomicalStructure')}
     )
-    return new_img
+    darrays = [
+        nb.gifti.GiftiDataArray(
+            row, intent='NIFTI_INTENT_NONE', meta=nb.gifti.GiftiMetaData(Name=name)
+        )
+        for row in np.atleast_2d(np.asarray(data))
+    ]
+    return nb.GiftiImage(meta=meta, darrays=darrays)
 
 
 class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, FunctionTask):
@@ -173,20 +235,10 @@ class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, Functi
         spec = self.inputs.spec
         mat = pd.read_csv(self.inputs.design_matrix, delimiter='\t', index_col=0)
         img = nb.load(self.inputs.bold_file)
+        precision = get_precision(self.inputs.precision)
 
         is_cifti = isinstance(img, nb.Cifti2Image)
-        if isinstance(img, nb.dataobj_images.DataobjImage):
-            # Ugly hack to ensure that retrieved data isn't cast to float64 unless
-            # necessary to prevent an overflow
-            # For NIfTI-1 files, slope and inter are 32-bit floats, so this is
-            # "safe". For NIfTI-2 (including CIFTI-2), these fields are 64-bit,
-            # so include a check to make sure casting doesn't lose too much.
-            slope32 = np.float32(img.dataobj._slope)
-            inter32 = np.float32(img.dataobj._inter)
-            close = partial(np.isclose, atol=1e-7, rtol=0)
-            if close(slope32, img.dataobj._slope) and close(inter32, img.dataobj._inter):
-                img.dataobj._slope = slope32
-                img.dataobj._inter = inter32
+        is_gifti = isinstance(img, nb.GiftiImage)
 
         mask_file = self.inputs.mask_file
         if mask_file in [None, attr.NOTHING]:
@@ -195,45 +247,106 @@ class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, Functi
         if smoothing_fwhm in [None, attr.NOTHING]:
             smoothing_fwhm = None
         smoothing_type = self.inputs.smoothing_type
-        if smoothing_type not in [None, attr.NOTHING] and smoothing_type != 'iso':
-            raise NotImplementedError(
-                "Only the iso smoothing type is available for the nilearn estimator."
+        if smoothing_type in [None, attr.NOTHING]:
+            smoothing_type = 'iso'
+        n_procs = get_n_procs(self.inputs.n_procs)
+        compact_outputs = self.inputs.compact_outputs is True and not (is_cifti or is_gifti)
+        if compact_outputs and mask_file is None:
+            raise ValueError("Compact outputs require a mask file")
+        if is_gifti:
+            if smoothing_fwhm is not None:
+                raise NotImplementedError("Smoothing is not available for GIFTI series.")
+            if self.inputs.container_outputs is True:
+                raise ValueError("GIFTI models write one file per map, not container outputs")
+        is_parcels = self.inputs.atlas not in [None, attr.NOTHING]
+        if is_parcels:
+            if is_cifti or is_gifti:
+                raise ValueError("Parcel models require a NIfTI series")
+            if smoothing_fwhm is not None:
+                raise NotImplementedError("Smoothing is not available for parcel models.")
+            if compact_outputs or self.inputs.container_outputs is True:
+                raise ValueError("Parcel models write tables, not compact or container outputs")
+            from nilearn.glm.first_level.first_level import mean_scaling
+
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.tsv').format
+            atlas = compile_atlas(
+                self.inputs.atlas, img, None if mask_file is None else compile_mask(mask_file, img)
             )
-        if is_cifti:
+            # Fit the percent signal change of parcel means, as nilearn does voxels
+            data, _ = mean_scaling(atlas.means(img, dtype=precision.data), 0)
+            to_map = partial(ParcelMap, atlas.labels)
+        elif is_cifti:
             fname_fmt = os.path.join(runtime.cwd, '{}_{}.dscalar.nii').format
-            labels, estimates = level1.run_glm(img.get_fdata(dtype='f4'), mat.values)
-            model_attr = {
-                'r_square': dscalar_from_cifti(
-                    img, _get_voxelwise_stat(labels, estimates, 'r_square'), 'r_square'
-                ),
-                'log_likelihood': dscalar_from_cifti(
-                    img, _get_voxelwise_stat(labels, estimates, 'logL'), 'log_likelihood'
-                ),
-            }
+            data = load_data(img, precision.data)
+            to_map = partial(dscalar_from_cifti, img)
+        elif is_gifti:
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.func.gii').format
+            data, to_map, _ = _load_first_level_run(self.inputs.bold_file, dtype=precision.data)
         else:
             fname_fmt = os.path.join(runtime.cwd, '{}_{}.nii.gz').format
-            flm = level1.FirstLevelModel(
-                minimize_memory=False, mask_img=mask_file, smoothing_fwhm=smoothing_fwhm
+            # Masks shared across runs in the same space are only loaded once
+            data, to_map, compiled_mask = _load_first_level_run(
+                self.inputs.bold_file,
+                mask_file,
+                smoothing_fwhm,
+                smoothing_type,
+                n_procs,
+                precision.data,
             )
-            flm.fit(img, design_matrices=mat)
-            model_attr = {
-                'r_square': flm.r_square[0],
-                'log_likelihood': flm.masker_.inverse_transform(
-                    _get_voxelwise_stat(flm.labels_[0], flm.results_[0], 'logL')
-                ),
-            }
+        labels, estimates = level1.run_glm(
+            data, mat.values.astype(precision.solve), n_jobs=n_procs
+        )
+        estimates = cast_results(estimates, precision.solve)
+
+        model_attr = {
+            stat: to_map(
+                _get_voxelwise_stat(labels, estimates, attr_name).astype(precision.data), stat
+            )
+            for stat, attr_name in (('r_square', 'r_square'), ('log_likelihood', 'logL'))
+        }
+        to_contrast_map = to_map
+        if compact_outputs:
+            # Contrast values are already in the order of the compiled mask
+            def to_contrast_map(values, name):
+                return compact_img(values, mask_file, compiled_mask, precision.data)
 
         out_ents = spec['entities'].copy()
 
+        if self.inputs.container_outputs is not True:
+            writer = MapWriter()
+        elif is_cifti:
+            writer = MapWriter(
+                os.path.join(runtime.cwd, 'maps.dscalar.nii'), dtype=precision.data
+            )
+        elif compact_outputs:
+            writer = MapWriter(
+                os.path.join(runtime.cwd, 'maps' + COMPACT_EXTENSION),
+                mask_file,
+                compiled_mask,
+                dtype=precision.data,
+            )
+        else:
+            writer = MapWriter(os.path.join(runtime.cwd, 'maps.nii.gz'), dtype=precision.data)
+
         # Save model level images
 
         model_maps = []
         model_metadata = []
-        for attr, img in model_attr.items():
-            model_metadata.append({'stat': attr, **out_ents})
-            fname = fname_fmt('model', attr)
-            img.to_filename(fname)
-            model_maps.append(fname)
+        for stat, img in model_attr.items():
+            model_metadata.append({'stat': stat, **out_ents})
+            fname = fname_fmt('model', stat)
+            model_maps.append(writer.save(img, fname, f'model_{stat}'))
+
+        # Residual smoothness is only defined on a voxel grid
+        if not (is_cifti or is_gifti or is_parcels):
+            fwhm, acf = estimate_smoothness(
+                _get_voxelwise_residuals(labels, estimates),
+                compiled_mask.mask,
+                nb.affines.voxel_sizes(compiled_mask.affine),
+            )
+            fname = fname_fmt('model', 'residsmoothness').replace('.nii.gz', '.tsv')
+            model_metadata.append({'stat': 'residsmoothness', **out_ents})
+            model_maps.append(write_smoothness(fname, fwhm, acf))
 
         effect_maps = []
         variance_maps = []
@@ -252,23 +365,13 @@ class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, Functi
                     **cont_ents,
                 }
             )
-            if is_cifti:
-                contrast = compute_contrast(
-                    labels, estimates, weights, contrast_type=contrast_test
+            contrast = compute_contrast(labels, estimates, weights, contrast_test)
+            maps = {
+                map_type: to_contrast_map(
+                    getattr(contrast, map_type)().astype(precision.data), map_type
                 )
-                maps = {
-                    map_type: dscalar_from_cifti(img, getattr(contrast, map_type)(), map_type)
-                    for map_type in [
-                        'z_score',
-                        'stat',
-                        'p_value',
-                        'effect_size',
-                        'effect_variance',
-                    ]
-                }
-
-            else:
-                maps = flm.compute_contrast(weights, contrast_test, output_type='all')
+                for map_type in ['z_score', 'stat', 'p_value', 'effect_size', 'effect_variance']
+            }
 
             for map_type, map_list in (
                 ('effect_size', effect_maps),
@@ -279,9 +382,13 @@ class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, Functi
             ):
 
                 fname = fname_fmt(name, map_type)
-                maps[map_type].to_filename(fname)
-                map_list.append(fname)
+                if compact_outputs:
+                    fname = fname.replace('.nii.gz', COMPACT_EXTENSION)
+                map_list.append(writer.save(maps[map_type], fname, f'{name}_{map_type}'))
 
+        writer.close()
+        if writer.container is not None:
+            self._results['map_container'] = writer.container
         self._results['effect_maps'] = effect_maps
         self._results['variance_maps'] = variance_maps
         self._results['stat_maps'] = stat_maps
@@ -294,15 +401,491 @@ class FirstLevelModel(NilearnBaseInterface, FirstLevelEstimatorInterface, Functi
         return runtime
 
 
+def _load_first_level_run(
+    bold_file,
+    mask_file=None,
+    smoothing_fwhm=None,
+    smoothing_type='iso',
+    n_procs=1,
+    dtype=np.float32,
+):
+    """Load a run as nilearn's FirstLevelModel would fit it
+    Returns the (n_vols x n_voxels) data in ``dtype``, a function mapping flattened
+    voxelwise values back to an image named by map type, and the
+    ``CompiledMask`` of the brain (``None`` for CIFTI-2 and GIFTI). NIfTI
+    series are masked, smoothed within the mask and scaled to percent signal
+    change; CIFTI-2 and GIFTI series are used as they are, with the data
+    arrays of a GIFTI series stacked as (n_vols x n_vertices). Without a mask
+    file, the mask is computed from the run, as nilearn does.
+    """
+    import nibabel as nb
+    from nilearn.glm.first_level.first_level import mean_scaling
+
+    img = nb.load(bold_file)
+    if isinstance(img, nb.Cifti2Image):
+        return load_data(img, dtype), partial(dscalar_from_cifti, img), None
+    if isinstance(img, nb.GiftiImage):
+        return load_data(img, dtype), partial(func_from_gifti, img), None
+
+    if mask_file is None:
+        from nilearn.maskers import NiftiMasker
+
+        mask_img = NiftiMasker(mask_strategy='epi').fit(img).mask_img_
+        compiled_mask = CompiledMask(np.asanyarray(mask_img.dataobj) > 0, img.affine)
+    else:
+        compiled_mask = compile_mask(mask_file, img)
+    data = compiled_mask.apply(img, dtype)
+    if smoothing_fwhm is not None:
+        data = smooth_in_mask(
+            data, compiled_mask, smoothing_fwhm, smoothing_type, n_procs, dtype=dtype
+        )
+    data, _ = mean_scaling(data, 0)
+    return data, lambda values, name: compiled_mask.unmask(values), compiled_mask
+
+
+class MultiRunFirstLevelModel(
+    NilearnBaseInterface, MultiRunFirstLevelEstimatorInterface, FunctionTask
+):
+    """Fit first level models of several runs, solving runs with a shared design together
+    Runs are grouped by design matrix and image type. The data of the runs in
+    a group are stacked as extra voxels of a single ``run_glm`` call, so the
+    design is whitened and decomposed once per AR(1) bin instead of once per
+    run. As nilearn bins AR(1) coefficients voxel by voxel, the estimates are
+    those of fitting each run alone. Outputs match those of
+    ``FirstLevelModel`` for each run, written to ``run-NNN`` subdirectories.
+    The left and right hemisphere GIFTI series of a run are listed as two runs
+    of ``bold_files``, and are fit together as they share a design.
+    Runs are loaded in a background thread, ``prefetch_depth`` runs ahead of
+    those being fit, with one of the ``n_procs`` CPUs given to loading.
+    """
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+        from nilearn.glm import first_level as level1
+        from nilearn.glm.contrasts import compute_contrast
+
+        specs = self.inputs.specs
+        bold_files = self.inputs.bold_files
+        n_procs = get_n_procs(self.inputs.n_procs)
+        precision = get_precision(self.inputs.precision)
+        mask_files = self.inputs.mask_files
+        if mask_files in [None, attr.NOTHING]:
+            mask_files = [None] * len(bold_files)
+        smoothing_fwhm = self.inputs.smoothing_fwhm
+        if smoothing_fwhm in [None, attr.NOTHING]:
+            smoothing_fwhm = None
+        smoothing_type = self.inputs.smoothing_type
+        if smoothing_type in [None, attr.NOTHING]:
+            smoothing_type = 'iso'
+        prefetch_depth = self.inputs.prefetch_depth
+        if prefetch_depth in [None, attr.NOTHING]:
+            prefetch_depth = 1
+
+        mats = [
+            pd.read_csv(fname, delimiter='\t', index_col=0)
+            for fname in self.inputs.design_matrices
+        ]
+        groups = {}
+        for idx, (bold_file, mat) in enumerate(zip(bold_files, mats)):
+            group_key = (_design_key(mat), bold_file.endswith('.dscalar.nii'))
+            groups.setdefault(group_key, []).append(idx)
+
+        outputs = {
+            key: [[] for _ in bold_files]
+            for key in (
+                'effect_maps',
+                'variance_maps',
+                'stat_maps',
+                'zscore_maps',
+                'pvalue_maps',
+                'contrast_metadata',
+                'model_maps',
+                'model_metadata',
+            )
+        }
+        map_outputs = {
+            'effect_size': 'effect_maps',
+            'effect_variance': 'variance_maps',
+            'z_score': 'zscore_maps',
+            'p_value': 'pvalue_maps',
+            'stat': 'stat_maps',
+        }
+
+        # A background loader takes one of the CPUs, and fits use the others
+        load_procs = n_procs if prefetch_depth == 0 else 1
+        fit_procs = n_procs if prefetch_depth == 0 else max(1, n_procs - 1)
+
+        def _load_run(idx):
+            return _load_first_level_run(
+                bold_files[idx],
+                mask_files[idx],
+                smoothing_fwhm,
+                smoothing_type,
+                load_procs,
+                precision.data,
+            )
+
+        # Upcoming runs are read and decompressed while the current group is fit
+        loaded_runs = prefetch(
+            _load_run, [idx for group in groups.values() for idx in group], prefetch_depth
+        )
+        for group in groups.values():
+            mat = mats[group[0]]
+            runs = [next(loaded_runs) for _ in group]
+            bounds = np.cumsum([0] + [data.shape[1] for data, _, _ in runs])
+            labels, estimates = level1.run_glm(
+                np.concatenate([data for data, _, _ in runs], axis=1),
+                mat.values.astype(precision.solve),
+                n_jobs=fit_procs,
+            )
+            estimates = cast_results(estimates, precision.solve)
+            model_stats = {
+                'r_square': _get_voxelwise_stat(labels, estimates, 'r_square'),
+                'log_likelihood': _get_voxelwise_stat(labels, estimates, 'logL'),
+            }
+            resid = _get_voxelwise_residuals(labels, estimates)
+            contrast_cache = {}
+
+            for offset, idx in enumerate(group):
+                spec = specs[idx]
+                _, to_img, compiled_mask = runs[offset]
+                cols = slice(bounds[offset], bounds[offset + 1])
+                out_ents = spec['entities'].copy()
+                out_dir = os.path.join(runtime.cwd, f'run-{idx:03d}')
+                os.makedirs(out_dir, exist_ok=True)
+                if compiled_mask is not None:
+                    ext = '.nii.gz'
+                elif bold_files[idx].endswith('.gii'):
+                    ext = '.func.gii'
+                else:
+                    ext = '.dscalar.nii'
+                fname_fmt = os.path.join(out_dir, '{}_{}' + ext).format
+
+                for stat, values in model_stats.items():
+                    outputs['model_metadata'][idx].append({'stat': stat, **out_ents})
+                    fname = fname_fmt('model', stat)
+                    to_img(values[:, cols].astype(precision.data), stat).to_filename(fname)
+                    outputs['model_maps'][idx].append(fname)
+
+                # Residual smoothness is only defined on a voxel grid
+                if compiled_mask is not None:
+                    fwhm, acf = estimate_smoothness(
+                        resid[:, cols],
+                        compiled_mask.mask,
+                        nb.affines.voxel_sizes(compiled_mask.affine),
+                    )
+                    fname = fname_fmt('model', 'residsmoothness').replace('.nii.gz', '.tsv')
+                    outputs['model_metadata'][idx].append({'stat': 'residsmoothness', **out_ents})
+                    outputs['model_maps'][idx].append(write_smoothness(fname, fwhm, acf))
+
+                for name, weights, cont_ents, contrast_test in prepare_contrasts(
+                    spec['contrasts'], mat.columns
+                ):
+                    outputs['contrast_metadata'][idx].append(
+                        {
+                            "name": spec['name'],
+                            "level": spec['level'],
+                            "stat": contrast_test,
+                            **cont_ents,
+                        }
+                    )
+                    # Runs in a group usually share their contrasts
+                    contrast_key = (DesignCache.key(weights), contrast_test)
+                    if contrast_key not in contrast_cache:
+                        contrast_cache[contrast_key] = compute_contrast(
+                            labels, estimates, weights, contrast_test
+                        )
+                    contrast = contrast_cache[contrast_key]
+                    for map_type, output in map_outputs.items():
+                        fname = fname_fmt(name, map_type)
+                        values = getattr(contrast, map_type)()[..., cols]
+                        to_img(values.astype(precision.data), map_type).to_filename(fname)
+                        outputs[output][idx].append(fname)
+
+        self._results.update(outputs)
+        return runtime
+
+
 def _flatten(x):
     return [elem for sublist in x for elem in sublist]
 
 
-def _match(query, metadata):
-    for key, val in query.items():
-        if metadata.get(key) != val:
-            return False
-    return True
+def _normalize(val):
+    if isinstance(val, list):
+        return tuple(_normalize(v) for v in val)
+    return val
+
+
+def _index_metadata(records, ignore=('datatype', 'desc', 'suffix', 'extension')):
+    """Index metadata records by their entity values
+    Returns a mapping from each (sorted) set of keys to a count of the records
+    with each tuple of values for those keys. Keys in ``ignore`` are dropped,
+    and records with missing (NaN) values are skipped, as they can never
+    match.
+    Examples
+    --------
+    >>> index = _index_metadata(
+    ...     [{'subject': '01', 'suffix': 'bold'}, {'subject': '02'}, {'subject': float('nan')}]
+    ... )
+    >>> _count_matches(index, {'subject': '01', 'contrast': 'a'})
+    1
+    >>> _count_matches(index, {'subject': '03', 'contrast': 'a'})
+    0
+    """
+    index = {}
+    for record in records:
+        ents = {key: val for key, val in record.items() if key not in ignore}
+        if any(isinstance(val, float) and val != val for val in ents.values()):
+            continue
+        keys = tuple(sorted(ents))
+        values = tuple(_normalize(ents[key]) for key in keys)
+        counts = index.setdefault(keys, {})
+        counts[values] = counts.get(values, 0) + 1
+    return index
+
+
+def _count_matches(index, metadata):
+    """Count the indexed records whose entities all match ``metadata``"""
+    return sum(
+        counts.get(tuple(_normalize(metadata.get(key)) for key in keys), 0)
+        for keys, counts in index.items()
+    )
+
+
+def _fixed_effects(effects, variances, counts):
+    """Fixed-effects combination of stacked input maps
+    Each row of ``effects`` and ``variances`` enters with weight ``counts``,
+    which is equivalent to the unweighted fixed effects of the inputs repeated
+    ``counts`` times. Rows with zero count are ignored.
+    Examples
+    --------
+    >>> effects = np.array([[1.0, 2.0], [3.0, 4.0], [9.0, 9.0]])
+    >>> variances = np.ones((3, 2))
+    >>> maps = _fixed_effects(effects, variances, np.array([1, 1, 0]))
+    >>> maps['effect_size'].tolist(), maps['effect_variance'].tolist()
+    ([2.0, 3.0], [0.5, 0.5])
+    """
+    tiny = 1.0e-16
+    n_inputs = counts.sum()
+    weights = counts.astype(effects.dtype)
+    used = counts > 0
+    effect = weights @ effects / n_inputs
+    variance = weights[used] @ np.maximum(variances[used], tiny) / n_inputs ** 2
+    return {
+        'effect_size': effect,
+        'effect_variance': variance,
+        'stat': effect / np.sqrt(variance),
+    }
+
+
+def _array_to_img(ref_img, values, name, dtype=np.float32):
+    """Wrap flattened map(s) on the grid of ``ref_img`` as a CIFTI-2, NIfTI or compact image"""
+    import nibabel as nb
+
+    values = np.atleast_2d(values).astype(dtype)
+    if isinstance(ref_img, nb.Cifti2Image):
+        return dscalar_from_cifti(ref_img, values, [name] * len(values))
+    reference = compact_reference(ref_img)
+    if reference is not None:
+        mask = compact_mask(ref_img)
+        return compact_img(
+            values[0] if len(values) == 1 else values, reference['MaskFile'], mask, dtype
+        )
+    vols = values.reshape((-1,) + ref_img.shape[:3])
+    return nb.Nifti1Image(vols[0] if len(vols) == 1 else np.moveaxis(vols, 0, -1), ref_img.affine)
+
+
+def _filter_inputs(spec_metadata, stat_metadata, *input_maps):
+    """Keep the input maps whose metadata match rows of the design
+    Inputs are repeated for each row of the design they match.
+    """
+    metadata_index = _index_metadata(spec_metadata)
+    filtered = [[] for _ in input_maps]
+    for m, *maps in zip(stat_metadata, *input_maps):
+        n_matches = _count_matches(metadata_index, m)
+        for out_list, fname in zip(filtered, maps):
+            out_list.extend([fname] * n_matches)
+    return filtered
+
+
+def _design_key(design):
+    """Hash a design matrix by its columns and values"""
+    import hashlib
+
+    dump = json.dumps([design.columns.tolist(), design.values.tolist()])
+    return hashlib.sha1(dump.encode()).hexdigest()
+
+
+def _input_key(fname):
+    """Identify an input file (or container map) by its path, size and modification time"""
+    fstat = os.stat(split_map_ref(fname)[0])
+    return [os.path.abspath(fname), fstat.st_size, fstat.st_mtime_ns]
+
+
+def _load_parcel_inputs(fnames, atlas_file=None, n_procs=1, dtype=np.float32, variance=False):
+    """Load input maps as (n_inputs x n_parcels) parcel means
+    Parcel tables are read as they are, and images are reduced to the parcels
+    of ``atlas_file``. With ``variance=True``, images are variance maps of
+    voxel effects, and each parcel takes the variance of the mean effect of
+    perfectly correlated voxels: the squared mean of their standard
+    deviations.
+    Returns the data, in ``dtype``, and the parcel labels.
+    """
+    if split_map_ref(fnames[0])[0].endswith('.tsv'):
+        data, labels = load_parcel_maps(fnames)
+        return data.astype(dtype, copy=False), labels
+    if atlas_file is None:
+        raise ValueError("Image inputs of a parcel model require an atlas")
+    data, ref_img = load_stacked(fnames, n_procs=n_procs, dtype=dtype)
+    if variance:
+        np.sqrt(data, out=data)
+    if compact_reference(ref_img) is not None:
+        # Compiled masks hold the grid of the compact values
+        mask = compact_mask(ref_img)
+        atlas = compile_atlas(atlas_file, mask, mask)
+        means = np.asarray(atlas.weights[:, mask.indices] @ data.T).T
+    elif len(ref_img.shape) != 3:
+        raise ValueError("Parcel models require NIfTI or parcel table inputs")
+    else:
+        atlas = compile_atlas(atlas_file, ref_img)
+        means = atlas.reduce(data)
+    return means**2 if variance else means, atlas.labels
+
+
+def _reference_affine(img):
+    """Affine of the grid of ``img`` as a nested list, or ``None`` for CIFTI-2 images"""
+    affine = getattr(img, 'affine', None)
+    return None if affine is None else np.asarray(affine, dtype=float).tolist()
+
+
+def _stream_ols(
+    fnames, design, columns, batch_size, n_procs=1, prior_stats=None, dtype=np.float32
+):
+    """Accumulate OLS sufficient statistics, reading ``batch_size`` maps at a time
+    Each input is recorded in a manifest by file identity and design row. If
+    ``prior_stats`` were saved from a design with the same columns on the same
+    grid, only the inputs added or removed since are read, and the prior sums
+    are updated in place. Designs that changed in structure, statistics saved
+    on another affine (see ``_reference_affine``), removed inputs whose files
+    are no longer as they were, and updates that would read at least as many
+    maps as a full refit all fall back to a full refit. Maps are read in
+    ``dtype``, and summed in float64.
+    Returns the ``SufficientStats``, the reference image and the manifest.
+    """
+    from collections import Counter
+
+    ref_img = load_map(fnames[0])
+    n_features = int(np.prod(ref_img.shape))
+    design = np.asarray(design, dtype=np.float64)
+    manifest = [
+        json.dumps(_input_key(fname) + [row]) for fname, row in zip(fnames, design.tolist())
+    ]
+
+    updates = [(fnames, design, 1)]
+    suff = None
+    if prior_stats not in [None, attr.NOTHING]:
+        prior, metadata = SufficientStats.load(prior_stats)
+        old_inputs, new_inputs = Counter(metadata['inputs']), Counter(manifest)
+        removed = [json.loads(entry) for entry in (old_inputs - new_inputs).elements()]
+        added = [json.loads(entry) for entry in (new_inputs - old_inputs).elements()]
+        prior_affine, affine = metadata.get('affine'), _reference_affine(ref_img)
+        same_grid = (
+            prior.xty.shape == (design.shape[1], n_features)
+            # Statistics saved without an affine predate its check, and are refit
+            and 'affine' in metadata
+            and (
+                prior_affine is affine is None
+                or (
+                    None not in (prior_affine, affine)
+                    and np.allclose(prior_affine, affine, atol=1e-5)
+                )
+            )
+        )
+        reusable = (
+            metadata['columns'] == list(columns)
+            and same_grid
+            # Changed design rows count inputs as both removed and added
+            and len(removed) + len(added) < len(fnames)
+            and all(
+                os.path.exists(split_map_ref(entry[0])[0])
+                and _input_key(entry[0]) == entry[:3]
+                for entry in removed
+            )
+        )
+        if reusable:
+            suff = prior
+            updates = [
+                ([entry[0] for entry in entries], np.array([entry[3] for entry in entries]), sign)
+                for entries, sign in ((removed, -1), (added, 1))
+                if entries
+            ]
+    if suff is None:
+        suff = SufficientStats(design.shape[1], n_features)
+
+    for update_files, update_design, sign in updates:
+        for start, data in iter_stacked(
+            update_files, batch_size, n_procs, dtype=dtype, ref_img=ref_img
+        ):
+            suff.update(update_design[start : start + len(data)], data, sign)
+    return suff, ref_img, manifest
+
+
+def _fit_mixed_effects(effects, variances, design, n_procs=1, block_size=10000, precision=None):
+    """Fit a mixed effects model block by block of features
+    Blocks are read and fit in the dtypes of ``precision`` (see
+    ``get_precision``). Returns the ``MixedEffectsResults``, the reference
+    image and a mask of features with nonzero effects in every input.
+    Examples
+    --------
+    >>> import nibabel as nb, tempfile
+    >>> rng = np.random.default_rng(0)
+    >>> effects = 1 + rng.normal(size=(12, 3, 3, 4))
+    >>> variances = rng.uniform(0.5, 2, size=(12, 3, 3, 4))
+    >>> fnames = {}
+    >>> for kind, maps in (('effect', effects), ('variance', variances)):
+    ...     fnames[kind] = [os.path.join(tempfile.mkdtemp(), f'{kind}.nii.gz') for _ in maps]
+    ...     for data, fname in zip(maps, fnames[kind]):
+    ...         nb.Nifti1Image(data.astype('f4'), np.eye(4)).to_filename(fname)
+    >>> design = np.column_stack([np.ones(12), rng.normal(size=12)])
+    >>> fit, _, mask = _fit_mixed_effects(
+    ...     fnames['effect'], fnames['variance'], design, block_size=10, precision='float64'
+    ... )
+    >>> whole = fit_mixed_effects(
+    ...     effects.reshape(12, -1).astype('f4'), variances.reshape(12, -1).astype('f4'), design
+    ... )
+    >>> blocked, alone = fit.contrast(np.eye(2), 'F'), whole.contrast(np.eye(2), 'F')
+    >>> bool(mask.all()), blocked['effect_size'].shape, blocked['effect_variance'].shape
+    (True, (2, 36), (1, 36))
+    >>> all(np.allclose(blocked[map_type], alone[map_type]) for map_type in blocked)
+    True
+    >>> effect, variance = blocked['effect_size'], blocked['effect_variance'][0]
+    >>> bool(np.allclose(blocked['stat'], (effect**2).sum(axis=0) / (2 * variance)))
+    True
+    """
+    precision = get_precision(precision)
+    ref_img = load_map(effects[0])
+    check_compatible(load_map(variances[0]), ref_img, variances[0])
+    n_features = int(np.prod(ref_img.shape))
+    n_regs = design.shape[1]
+    betas = np.zeros((n_regs, n_features), dtype=precision.solve)
+    cov = np.zeros((n_features, n_regs, n_regs), dtype=precision.solve)
+    tau2 = np.zeros(n_features, dtype=precision.solve)
+    mask = np.zeros(n_features, dtype=bool)
+    for (index, eff_block), (_, var_block) in zip(
+        iter_blocks(effects, block_size, n_procs, precision.data),
+        iter_blocks(variances, block_size, n_procs, precision.data),
+    ):
+        valid = (eff_block != 0).all(axis=0)
+        index = index[valid]
+        block = fit_mixed_effects(
+            eff_block[:, valid], var_block[:, valid], design, dtype=precision.solve
+        )
+        betas[:, index] = block.betas
+        cov[index] = block.cov
+        tau2[index] = block.tau2
+        mask[index] = True
+    dof = design.shape[0] - int(np.linalg.matrix_rank(design))
+    return MixedEffectsResults(betas, cov, tau2, dof), ref_img, mask
 
 
 class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, FunctionTask):
@@ -310,75 +893,210 @@ class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, Func
         import nibabel as nb
         from nilearn.glm import second_level as level2
         from nilearn.glm import first_level as level1
-        from nilearn.glm.contrasts import (
-            compute_contrast,
-            compute_fixed_effects,
-            _compute_fixed_effects_params,
-        )
+        from nilearn.glm.contrasts import compute_contrast
 
         spec = self.inputs.spec
+        n_procs = get_n_procs(self.inputs.n_procs)
+        precision = get_precision(self.inputs.precision)
+        stream_batch_size = self.inputs.stream_batch_size
+        if stream_batch_size in [None, attr.NOTHING]:
+            stream_batch_size = None
+            if self.inputs.prior_stats not in [None, attr.NOTHING]:
+                raise ValueError("Prior sufficient statistics require stream_batch_size")
+        n_permutations = self.inputs.n_permutations
+        if n_permutations in [None, attr.NOTHING]:
+            n_permutations = 0
+        if n_permutations and stream_batch_size:
+            raise ValueError("Permutation inference requires inputs held in memory")
+        random_seed = self.inputs.random_seed
+        if random_seed in [None, attr.NOTHING]:
+            random_seed = 0
+        mixed_effects = self.inputs.mixed_effects is True
+        if mixed_effects and (stream_batch_size or n_permutations):
+            raise ValueError("Mixed effects models cannot be streamed or permuted")
         smoothing_fwhm = self.inputs.smoothing_fwhm
         smoothing_type = self.inputs.smoothing_type
         if smoothing_fwhm in [None, attr.NOTHING]:
             smoothing_fwhm = None
-        if smoothing_type not in [None, attr.NOTHING] and smoothing_type != 'iso':
-            raise NotImplementedError(
-                "Only the iso smoothing type is available for the nilearn estimator."
-            )
+        if smoothing_type in [None, attr.NOTHING]:
+            smoothing_type = 'iso'
 
         effect_maps = []
         variance_maps = []
         stat_maps = []
         zscore_maps = []
         pvalue_maps = []
+        perm_pvalue_maps = []
+        fwe_pvalue_maps = []
         contrast_metadata = []
         spec_metadata = spec['metadata'].to_dict('records')
         out_ents = spec['entities'].copy()  # Same for all
         out_ents.setdefault("contrast", spec['contrasts'][0]['name'])
 
         # Only keep files which match all entities for contrast
-        stat_metadata = _flatten(self.inputs.stat_metadata)
-        input_effects = _flatten(self.inputs.effect_maps)
-        input_variances = _flatten(self.inputs.variance_maps)
-
-        filtered_effects = []
-        filtered_variances = []
-        names = []
-        for m, eff, var in zip(stat_metadata, input_effects, input_variances):
-            for ents in spec_metadata:
-                for key in ('datatype', 'desc', 'suffix', 'extension'):
-                    ents.pop(key, None)
-                if _match(ents, m):
-                    filtered_effects.append(eff)
-                    filtered_variances.append(var)
-                    names.append(m['contrast'])
+        filtered_effects, filtered_variances = _filter_inputs(
+            spec_metadata,
+            _flatten(self.inputs.stat_metadata),
+            _flatten(self.inputs.effect_maps),
+            _flatten(self.inputs.variance_maps),
+        )
 
         contrasts = prepare_contrasts(spec['contrasts'], spec['X'].columns)
 
-        is_cifti = filtered_effects[0].endswith('dscalar.nii')
-        if is_cifti:
+        # Inputs may be maps of a first level container
+        input_file = split_map_ref(filtered_effects[0])[0]
+        is_cifti = input_file.endswith('dscalar.nii')
+        # Compact in-mask inputs give compact outputs, for the next level or the sink
+        is_compact = input_file.endswith(COMPACT_EXTENSION)
+        atlas_file = self.inputs.atlas
+        if atlas_file in [None, attr.NOTHING]:
+            atlas_file = None
+        # Parcel tables from first level models need no atlas
+        is_parcels = atlas_file is not None or input_file.endswith('.tsv')
+        if is_parcels:
+            if smoothing_fwhm is not None:
+                raise NotImplementedError("Smoothing is not available for parcel models.")
+            if stream_batch_size:
+                raise ValueError("Parcel models are fit in memory, and cannot be streamed")
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}.tsv').format
+        elif is_cifti:
             fname_fmt = os.path.join(runtime.cwd, '{}_{}.dscalar.nii').format
+        elif is_compact:
+            fname_fmt = os.path.join(runtime.cwd, '{}_{}' + COMPACT_EXTENSION).format
         else:
             fname_fmt = os.path.join(runtime.cwd, '{}_{}.nii.gz').format
 
         model_type = spec["model"].get("type", "")
 
         # Do not fit model for meta-analyses
-        if model_type != 'Meta':
+        if model_type == 'Meta':
+            # Load each input once; contrasts reduce over rows of the stacked arrays
+            input_pairs = list(dict.fromkeys(zip(filtered_effects, filtered_variances)))
+            pair_rows = {pair: ii for ii, pair in enumerate(input_pairs)}
+            input_rows = np.array(
+                [pair_rows[pair] for pair in zip(filtered_effects, filtered_variances)]
+            )
+            if is_parcels:
+                meta_effects, parcels = _load_parcel_inputs(
+                    [eff for eff, _ in input_pairs], atlas_file, n_procs, precision.data
+                )
+                meta_variances, _ = _load_parcel_inputs(
+                    [var for _, var in input_pairs],
+                    atlas_file,
+                    n_procs,
+                    precision.data,
+                    variance=True,
+                )
+            else:
+                meta_effects, ref_img = load_stacked(
+                    [eff for eff, _ in input_pairs], n_procs=n_procs, dtype=precision.data
+                )
+                meta_variances, var_img = load_stacked(
+                    [var for _, var in input_pairs], n_procs=n_procs, dtype=precision.data
+                )
+                check_compatible(var_img, ref_img, input_pairs[0][1])
+            # First-level maps are zero outside of the brain
+            meta_mask = (meta_effects != 0).any(axis=0)
+        else:
             if len(filtered_effects) < 2:
                 raise RuntimeError(
                     "At least two inputs are required for a 't' for 'F' " "second level contrast"
                 )
-            if is_cifti:
-                effect_data = np.squeeze(
-                    [nb.load(effect).get_fdata(dtype='f4') for effect in filtered_effects]
+            if (stream_batch_size or mixed_effects) and smoothing_fwhm is not None:
+                raise NotImplementedError(
+                    "Smoothing is not available for streamed or mixed effects second level models."
+                )
+            if is_parcels:
+                effect_data, parcels = _load_parcel_inputs(
+                    filtered_effects, atlas_file, n_procs, precision.data
+                )
+                if mixed_effects:
+                    variance_data, _ = _load_parcel_inputs(
+                        filtered_variances, atlas_file, n_procs, precision.data, variance=True
+                    )
+                    fit_mask = (effect_data != 0).all(axis=0)
+                    fit = fit_mixed_effects(
+                        effect_data[:, fit_mask],
+                        variance_data[:, fit_mask],
+                        spec['X'].values,
+                        dtype=precision.solve,
+                    )
+                else:
+                    labels, estimates = level1.run_glm(
+                        effect_data, spec['X'].values.astype(precision.solve), noise_model='ols'
+                    )
+                    estimates = cast_results(estimates, precision.solve)
+                    perm_data = effect_data
+            elif mixed_effects:
+                fit, ref_img, fit_mask = _fit_mixed_effects(
+                    filtered_effects,
+                    filtered_variances,
+                    spec['X'].values,
+                    n_procs,
+                    precision=self.inputs.precision,
+                )
+            elif stream_batch_size:
+                suff, ref_img, manifest = _stream_ols(
+                    filtered_effects,
+                    spec['X'].values,
+                    spec['X'].columns,
+                    stream_batch_size,
+                    n_procs,
+                    self.inputs.prior_stats,
+                    precision.data,
+                )
+                fit = suff.fit()
+                # CIFTI-2 features are all in the brain
+                fit_mask = np.ones_like(suff.mask) if is_cifti else suff.mask
+                self._results['sufficient_stats'] = suff.save(
+                    os.path.join(runtime.cwd, 'sufficient_stats.npz'),
+                    columns=spec['X'].columns.tolist(),
+                    inputs=manifest,
+                    affine=_reference_affine(ref_img),
+                )
+            elif is_cifti:
+                effect_data, ref_img = load_stacked(
+                    filtered_effects, n_procs=n_procs, dtype=precision.data
                 )
                 labels, estimates = level1.run_glm(
-                    effect_data, spec['X'].values, noise_model='ols'
+                    effect_data, spec['X'].values.astype(precision.solve), noise_model='ols'
                 )
+                estimates = cast_results(estimates, precision.solve)
+                perm_data = effect_data
             else:
-                model = level2.SecondLevelModel(smoothing_fwhm=smoothing_fwhm)
-                model.fit(filtered_effects, design_matrix=spec['X'])
+                effect_data, ref_img = load_stacked(
+                    filtered_effects, n_procs=n_procs, dtype=precision.data
+                )
+                input_mask = None
+                if is_compact:
+                    # Fit within the referenced mask, rather than computing one from the data
+                    input_mask = compact_mask(ref_img)
+                elif smoothing_fwhm is not None:
+                    # First-level maps are zero outside of the brain
+                    input_mask = CompiledMask(
+                        (effect_data != 0).all(axis=0).reshape(ref_img.shape[:3]),
+                        ref_img.affine,
+                    )
+                    effect_data = effect_data[:, input_mask.indices]
+                if input_mask is None:
+                    effect_img = stacked_to_img(effect_data, ref_img)
+                    model = level2.SecondLevelModel()
+                else:
+                    if smoothing_fwhm is not None:
+                        effect_data = smooth_in_mask(
+                            effect_data,
+                            input_mask,
+                            smoothing_fwhm,
+                            smoothing_type,
+                            n_procs,
+                            dtype=precision.data,
+                        )
+                    effect_img = input_mask.unmask(effect_data)
+                    model = level2.SecondLevelModel(mask_img=input_mask.mask_img())
+                model.fit(effect_img, design_matrix=spec['X'])
+                if n_permutations:
+                    # Permute the masked, smoothed data that the model was fit to
+                    perm_data = model.masker_.transform(effect_img)
 
         for name, weights, cont_ents, contrast_test in contrasts:
             contrast_metadata.append(
@@ -397,40 +1115,68 @@ class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, Func
                 # Index of all input files "involved" with that contrast
                 dm_ix = spec['X'].iloc[:, con_ix].any(axis=1)
 
-                contrast_imgs = np.array(filtered_effects)[dm_ix]
-                variance_imgs = np.array(filtered_variances)[dm_ix]
-                if is_cifti:
-                    ffx_cont, ffx_var, ffx_t = _compute_fixed_effects_params(
-                        np.squeeze(
-                            [nb.load(fname).get_fdata(dtype='f4') for fname in contrast_imgs]
-                        ),
-                        np.squeeze(
-                            [nb.load(fname).get_fdata(dtype='f4') for fname in variance_imgs]
-                        ),
-                        precision_weighted=False,
-                    )
-                    img = nb.load(filtered_effects[0])
+                # Inputs may enter the design several times; weight each by its count
+                counts = np.bincount(input_rows[dm_ix.values], minlength=len(input_pairs))
+                ffx_maps = _fixed_effects(meta_effects, meta_variances, counts)
+                if is_parcels:
                     maps = {
-                        'effect_size': dscalar_from_cifti(img, ffx_cont, "effect_size"),
-                        'effect_variance': dscalar_from_cifti(img, ffx_var, "effect_variance"),
-                        'stat': dscalar_from_cifti(img, ffx_t, "stat"),
+                        map_type: ParcelMap(parcels, np.where(meta_mask, values, 0), map_type)
+                        for map_type, values in ffx_maps.items()
+                    }
+                elif is_cifti:
+                    maps = {
+                        map_type: dscalar_from_cifti(ref_img, values, map_type)
+                        for map_type, values in ffx_maps.items()
+                    }
+                elif is_compact:
+                    maps = {
+                        map_type: _array_to_img(
+                            ref_img, np.where(meta_mask, values, 0), map_type, precision.data
+                        )
+                        for map_type, values in ffx_maps.items()
                     }
-
                 else:
-                    ffx_res = compute_fixed_effects(contrast_imgs, variance_imgs)
                     maps = {
-                        'effect_size': ffx_res[0],
-                        'effect_variance': ffx_res[1],
-                        'stat': ffx_res[2],
+                        map_type: nb.Nifti1Image(
+                            np.where(meta_mask, values, 0).reshape(ref_img.shape),
+                            ref_img.affine,
+                        )
+                        for map_type, values in ffx_maps.items()
                     }
+            elif is_parcels and mixed_effects:
+                maps = {}
+                for map_type, values in fit.contrast(weights, contrast_test).items():
+                    parcel_values = np.zeros(np.shape(values)[:-1] + (len(parcels),))
+                    parcel_values[..., fit_mask] = values
+                    maps[map_type] = ParcelMap(parcels, parcel_values, map_type)
+            elif stream_batch_size or mixed_effects:
+                maps = {
+                    map_type: _array_to_img(
+                        ref_img, np.where(fit_mask, values, 0), map_type, precision.data
+                    )
+                    for map_type, values in fit.contrast(weights, contrast_test).items()
+                }
             else:
-                if is_cifti:
+                if is_parcels:
+                    contrast = compute_contrast(labels, estimates, weights, contrast_test)
+                    maps = {
+                        map_type: ParcelMap(parcels, getattr(contrast, map_type)(), map_type)
+                        for map_type in [
+                            'z_score',
+                            'stat',
+                            'p_value',
+                            'effect_size',
+                            'effect_variance',
+                        ]
+                    }
+                elif is_cifti:
                     contrast = compute_contrast(
                         labels, estimates, weights, contrast_type=contrast_test
                     )
-                    img = nb.load(filtered_effects[0])
                     maps = {
-                        map_type: dscalar_from_cifti(img, getattr(contrast, map_type)(), map_type)
+                        map_type: dscalar_from_cifti(
+                            ref_img, getattr(contrast, map_type)(), map_type
+                        )
                         for map_type in [
                             'z_score',
                             'stat',
@@ -445,6 +1191,39 @@ class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, Func
                         second_level_stat_type=contrast_test,
                         output_type='all',
                     )
+                    if is_compact:
+                        maps = {
+                            map_type: _array_to_img(
+                                ref_img,
+                                input_mask.apply(img, precision.data),
+                                map_type,
+                                precision.data,
+                            )
+                            for map_type, img in maps.items()
+                        }
+
+                if n_permutations:
+                    perm_pvals = permutation_test(
+                        perm_data,
+                        spec['X'].values,
+                        weights,
+                        contrast_test,
+                        n_permutations,
+                        seed=random_seed,
+                        n_procs=n_procs,
+                        dtype=precision.solve,
+                    )
+                    for map_type, values in perm_pvals.items():
+                        if is_parcels:
+                            maps[map_type] = ParcelMap(parcels, values, map_type)
+                        elif is_cifti:
+                            maps[map_type] = dscalar_from_cifti(ref_img, values, map_type)
+                        elif is_compact:
+                            maps[map_type] = _array_to_img(
+                                ref_img, values, map_type, precision.data
+                            )
+                        else:
+                            maps[map_type] = model.masker_.inverse_transform(values)
 
             for map_type, map_list in (
                 ('effect_size', effect_maps),
@@ -452,9 +1231,13 @@ class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, Func
                 ('z_score', zscore_maps),
                 ('p_value', pvalue_maps),
                 ('stat', stat_maps),
+                ('p_value_perm', perm_pvalue_maps),
+                ('p_value_fwe', fwe_pvalue_maps),
             ):
                 if map_type in maps:
                     fname = fname_fmt(name, map_type)
+                    if isinstance(maps[map_type], nb.spatialimages.SpatialImage):
+                        maps[map_type].set_data_dtype(precision.data)
                     maps[map_type].to_filename(fname)
                     map_list.append(fname)
 
@@ -468,5 +1251,157 @@ class SecondLevelModel(NilearnBaseInterface, SecondLevelEstimatorInterface, Func
             self._results['zscore_maps'] = zscore_maps
         if pvalue_maps:
             self._results['pvalue_maps'] = pvalue_maps
+        if perm_pvalue_maps:
+            self._results['perm_pvalue_maps'] = perm_pvalue_maps
+            self._results['fwe_pvalue_maps'] = fwe_pvalue_maps
+
+        return runtime
+
+
+class BatchSecondLevelModel(
+    NilearnBaseInterface, BatchSecondLevelEstimatorInterface, FunctionTask
+):
+    """Fit OLS second level models for many specs, once per distinct design
+    Specs are grouped by a hash of their design matrix. The inputs of every
+    spec in a group are stacked as extra features of a single model, which is
+    solved once and split back into per-spec outputs, written to ``spec-NNN``
+    subdirectories in the order of ``specs``.
+    Examples
+    --------
+    The contrasts of a spec in a batch match those of the OLS fit of nilearn
+    that ``SecondLevelModel`` makes of the spec alone, for F-tests as well:
+    >>> from nilearn.glm.contrasts import compute_contrast
+    >>> from nilearn.glm.first_level import run_glm
+    >>> rng = np.random.default_rng(0)
+    >>> design = np.column_stack([np.ones(8), rng.normal(size=8)])
+    >>> spec_data = [rng.normal(size=(8, 5)) + 1 for _ in range(2)]
+    >>> suff = SufficientStats(2, 10)
+    >>> suff.update(design, np.concatenate(spec_data, axis=1))
+    >>> batched = suff.fit().select(slice(5, 10)).contrast(np.eye(2), 'F')
+    >>> labels, estimates = run_glm(spec_data[1], design, noise_model='ols')
+    >>> alone = compute_contrast(labels, estimates, np.eye(2), 'F')
+    >>> [
+    ...     bool(np.allclose(batched[map_type], getattr(alone, map_type)()))
+    ...     for map_type in ('effect_size', 'effect_variance', 'stat', 'z_score', 'p_value')
+    ... ]
+    [True, True, True, True, True]
+    """
 
-        return runtime
\ No newline at end of file
+    def _run_interface(self, runtime):
+        import nibabel as nb
+
+        specs = self.inputs.specs
+        n_procs = get_n_procs(self.inputs.n_procs)
+        precision = get_precision(self.inputs.precision)
+        batch_size = self.inputs.stream_batch_size
+        if batch_size in [None, attr.NOTHING]:
+            batch_size = None
+
+        spec_inputs = []
+        groups = {}
+        for idx, (spec, stat_metadata, effects) in enumerate(
+            zip(specs, self.inputs.stat_metadata, self.inputs.effect_maps)
+        ):
+            if spec["model"].get("type", "") == 'Meta':
+                raise NotImplementedError(
+                    "Meta-analyses are not available for batched second level models."
+                )
+            (filtered_effects,) = _filter_inputs(
+                spec['metadata'].to_dict('records'), stat_metadata, effects
+            )
+            if len(filtered_effects) < 2:
+                raise RuntimeError(
+                    "At least two inputs are required for a 't' for 'F' " "second level contrast"
+                )
+            if len(filtered_effects) != len(spec['X']):
+                # Specs are read in lockstep, one design row per input
+                raise ValueError(
+                    f"Spec {idx} has {len(filtered_effects)} inputs for "
+                    f"{len(spec['X'])} design rows"
+                )
+            spec_inputs.append(filtered_effects)
+            input_img = load_map(filtered_effects[0])
+            group_key = (
+                _design_key(spec['X']),
+                input_img.shape,
+                json.dumps(compact_reference(input_img)),
+            )
+            groups.setdefault(group_key, []).append(idx)
+
+        outputs = {
+            key: [[] for _ in specs]
+            for key in (
+                'effect_maps',
+                'variance_maps',
+                'stat_maps',
+                'zscore_maps',
+                'pvalue_maps',
+                'contrast_metadata',
+            )
+        }
+        map_outputs = {
+            'effect_size': 'effect_maps',
+            'effect_variance': 'variance_maps',
+            'stat': 'stat_maps',
+            'z_score': 'zscore_maps',
+            'p_value': 'pvalue_maps',
+        }
+
+        for group in groups.values():
+            design = specs[group[0]]['X'].values
+            ref_img = load_map(spec_inputs[group[0]][0])
+            is_cifti = isinstance(ref_img, nb.Cifti2Image)
+            if is_cifti:
+                ext = '.dscalar.nii'
+            elif compact_reference(ref_img) is not None:
+                ext = COMPACT_EXTENSION
+            else:
+                ext = '.nii.gz'
+            n_features = int(np.prod(ref_img.shape))
+
+            # Inputs of each spec are stacked side by side, row by row of the design
+            suff = SufficientStats(design.shape[1], n_features * len(group))
+            readers = [
+                iter_stacked(
+                    spec_inputs[idx],
+                    batch_size or len(design),
+                    n_procs,
+                    dtype=precision.data,
+                    ref_img=ref_img,
+                )
+                for idx in group
+            ]
+            for batches in zip(*readers):
+                start = batches[0][0]
+                data = np.concatenate([batch for _, batch in batches], axis=1)
+                suff.update(design[start : start + len(data)], data)
+            ols = suff.fit()
+
+            for offset, idx in enumerate(group):
+                spec = specs[idx]
+                features = slice(offset * n_features, (offset + 1) * n_features)
+                spec_ols = ols.select(features)
+                mask = np.ones(n_features, dtype=bool) if is_cifti else suff.mask[features]
+                out_dir = os.path.join(runtime.cwd, f'spec-{idx:03d}')
+                os.makedirs(out_dir, exist_ok=True)
+
+                for name, weights, cont_ents, contrast_test in prepare_contrasts(
+                    spec['contrasts'], spec['X'].columns
+                ):
+                    outputs['contrast_metadata'][idx].append(
+                        {
+                            "name": spec['name'],
+                            "level": spec['level'],
+                            "stat": contrast_test,
+                            **cont_ents,
+                        }
+                    )
+                    for map_type, values in spec_ols.contrast(weights, contrast_test).items():
+                        fname = os.path.join(out_dir, f'{name}_{map_type}{ext}')
+                        _array_to_img(
+                            ref_img, np.where(mask, values, 0), map_type, precision.data
+                        ).to_filename(fname)
+                        outputs[map_outputs[map_type]][idx].append(fname)
+
+        self._results.update(outputs)
+        return runtime
@@ -17,6 +17,9 @@ from pydra.engine.specs import File, SpecInfo, BaseSpec
 from pydra.engine.task import FunctionTask
 
 from ..viz import plot_and_save, plot_corr_matrix, plot_contrast_matrix
+from ..utils.images import load_map, split_map_ref
+from ..utils.loading import load_data
+from ..utils.masks import expand_compact, is_compact
 
 Visualization_input_fields = [
     (
@@ -77,9 +80,13 @@ class Visualization(FunctionTask):
         plt.rcParams['image.interpolation'] = 'nearest'
 
         data = self._load_data(self.inputs.data)
+        # Maps of a container are named by their index
+        path, map_index = split_map_ref(self.inputs.data)
         out_name = fname_presuffix(
-            self.inputs.data,
-            suffix='.' + self.inputs.image_type,
+            path,
+            suffix=('' if map_index is None else f'_map-{map_index}')
+            + '.'
+            + self.inputs.image_type,
             newpath=runtime.cwd,
             use_ext=False,
         )
@@ -88,6 +95,11 @@ class Visualization(FunctionTask):
         return runtime
 
     def _load_data(self, fname):
+        path, map_index = split_map_ref(fname)
+        if is_compact(path):
+            return expand_compact(load_map(fname))
+        if map_index is not None:
+            return load_map(fname)
         _, _, ext = split_filename(fname)
         if ext == '.tsv':
             return pd.read_table(fname, index_col=0)
@@ -279,7 +291,7 @@ class GlassBrainPlot(Visualization):
         vmax = self.inputs.vmax
         if vmax in [None, attr.NOTHING]:
             vmax = None
-            abs_data = np.abs(data.get_fdata(dtype=np.float32))
+            abs_data = np.abs(load_data(data))
             pctile99 = np.percentile(abs_data, 99.99)
             if abs_data.max() - pctile99 > 10:
                 vmax = pctile99
@@ -340,7 +352,7 @@ def plot_dscalar(
     nlp.plot_surf_stat_map(rsurf, rtexture, view='lateral', axes=ax4, **kwargs)
     nlp.plot_glass_brain(subcort, display_mode='lyrz', axes=ax5, **kwargs)
     if colorbar:
-        data = img.get_fdata(dtype=np.float32)
+        data = load_data(img)
         if vmax is None:
             vmax = max(-data.min(), data.max())
         norm = mpl.colors.Normalize(vmin=-vmax if data.min() < 0 else 0, vmax=vmax)
@@ -352,7 +364,7 @@ def plot_dscalar(
 
 
 def decompose_dscalar(img):
-    data = img.get_fdata(dtype=np.float32)
+    data = load_data(img)
     ax = img.header.get_axis(1)
     vol = np.zeros(ax.volume_shape, dtype=np.float32)
     vox_indices = tuple(ax.voxel[ax.volume_mask].T)
@@ -6,4 +6,5 @@ imported.
 """
 
 from .strings import snake_to_camel, to_alphanum
-from .collections import dict_intersection
\ No newline at end of file
+from .collections import dict_intersection
+from .parallel import get_n_procs, prefetch, run_dag
\ No newline at end of file
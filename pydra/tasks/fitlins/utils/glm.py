@@ -0,0 +1,593 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+DesignInfo = namedtuple('DesignInfo', ('pinv', 'cov', 'rank', 'basis', 'logdet_xtx'))
+
+
+def decompose_design(design):
+    """Decompose a design matrix into the quantities needed to fit it
+    Returns a ``DesignInfo`` with the pseudo-inverse, the normalized parameter
+    covariance ``pinv(X.T @ X)``, the rank, an orthonormal basis for the column
+    space and the log pseudo-determinant of ``X.T @ X``. Arrays are read-only,
+    so that they can be shared through a ``DesignCache``.
+    Examples
+    --------
+    >>> info = decompose_design(np.array([[1.0, 0.0], [1.0, 1.0], [1.0, 2.0]]))
+    >>> info.rank
+    2
+    >>> np.allclose(info.cov, np.linalg.inv([[3.0, 3.0], [3.0, 5.0]]))
+    True
+    """
+    design = np.asarray(design, dtype=np.float64)
+    u, s, vt = np.linalg.svd(design, full_matrices=False)
+    rank = int((s > s.max() * max(design.shape) * np.finfo(s.dtype).eps).sum())
+    u, s, vt = u[:, :rank], s[:rank], vt[:rank]
+    info = DesignInfo(
+        pinv=(vt.T / s) @ u.T,
+        cov=(vt.T / s**2) @ vt,
+        rank=rank,
+        basis=u,
+        logdet_xtx=2 * np.log(s).sum(),
+    )
+    for array in (info.pinv, info.cov, info.basis):
+        array.setflags(write=False)
+    return info
+
+
+class DesignCache:
+    """Bounded, content-addressed stores of design decompositions and contrast projections
+    Entries are keyed on the bytes of the design (and contrast weights), so
+    runs and specs that share a design share a single decomposition.
+    Decompositions and projections are kept in separate stores, each evicting
+    its least recently used entries beyond its size, so that the projections
+    of a model cannot evict the decompositions they are computed from.
+    ``reserve`` grows the stores to hold a whole model, such as the whitened
+    designs of every ARMA grid cell and their projections for every contrast.
+    Examples
+    --------
+    >>> cache = DesignCache(designs=1, projections=1)
+    >>> design = np.ones((4, 1))
+    >>> cache.design(design) is cache.design(design.copy())
+    True
+    >>> float(cache.projection(design, [[2.0]])[0, 0])
+    1.0
+    >>> float(cache.projection(design, [[4.0]])[0, 0])
+    4.0
+    >>> len(cache)
+    2
+    >>> cache.reserve(projections=2)
+    >>> cache.maxsize
+    {'design': 1, 'projection': 2}
+    """
+
+    def __init__(self, designs=1024, projections=4096):
+        self.maxsize = {'design': designs, 'projection': projections}
+        self._entries = {kind: OrderedDict() for kind in self.maxsize}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def reserve(self, designs=0, projections=0):
+        """Grow the stores to hold at least ``designs`` and ``projections`` entries"""
+        with self._lock:
+            self.maxsize['design'] = max(self.maxsize['design'], designs)
+            self.maxsize['projection'] = max(self.maxsize['projection'], projections)
+
+    @staticmethod
+    def key(*arrays):
+        """Hash arrays by their dtype, shape and contents"""
+        digest = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def get(self, kind, key, compute):
+        """Return the ``kind`` entry for ``key``, computing and storing it if missing"""
+        entries = self._entries[kind]
+        with self._lock:
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+        value = compute()
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.maxsize[kind]:
+                entries.popitem(last=False)
+        return value
+
+    def design(self, design):
+        """``decompose_design(design)``, cached"""
+        return self.get('design', self.key(design), lambda: decompose_design(design))
+
+    def normal(self, xtx):
+        """Pseudo-inverse and rank of a ``X.T @ X`` matrix, cached"""
+
+        def _invert():
+            cov = np.linalg.pinv(xtx)
+            cov.setflags(write=False)
+            return cov, int(np.linalg.matrix_rank(xtx))
+
+        return self.get('design', ('normal', self.key(xtx)), _invert)
+
+    def projection(self, design, weights):
+        """Contrast projection ``weights @ cov @ weights.T`` of a design, cached"""
+        weights = np.atleast_2d(weights)
+
+        def _project():
+            proj = weights @ self.design(design).cov @ weights.T
+            proj.setflags(write=False)
+            return proj
+
+        return self.get('projection', (self.key(design), self.key(weights)), _project)
+
+
+# Shared by all estimators in a process
+design_cache = DesignCache()
+
+
+def _inv_sqrt(proj):
+    """Inverse square root of symmetric positive semidefinite matrices, or a stack of them"""
+    eigvals, eigvecs = np.linalg.eigh(proj)
+    tol = eigvals.max(axis=-1, keepdims=True) * proj.shape[-1] * np.finfo(eigvals.dtype).eps
+    scale = np.where(eigvals > tol, 1 / np.sqrt(np.where(eigvals > tol, eigvals, 1)), 0)
+    return (eigvecs * scale[..., None, :]) @ np.swapaxes(eigvecs, -1, -2)
+
+
+def contrast_stats(effect, proj, sigma2, dof, test):
+    """Statistics of a contrast of GLM parameter estimates
+    Outputs follow nilearn's ``compute_contrast``. For F-tests, the effect
+    size is the contrast whitened by the inverse square root of ``proj``,
+    and the effect variance is the residual variance, so that estimators
+    built on these statistics write the same F maps as nilearn's models.
+    Parameters
+    ----------
+    effect : (n_rows, n_voxels) array
+        Contrast of the parameter estimates
+    proj : (n_rows, n_rows) or (n_voxels, n_rows, n_rows) array
+        Contrast projection of the unscaled parameter covariance,
+        ``weights @ cov @ weights.T``, shared or for each voxel
+    sigma2 : (n_voxels,) array
+        Residual variance
+    dof : int
+        Residual degrees of freedom
+    test : str
+        ``'t'`` or ``'F'``; t-tests only use the first row of the contrast
+    Returns
+    -------
+    dict
+        ``effect_size`` (one row per contrast row of F-tests),
+        ``effect_variance`` (a single row), ``stat``, ``z_score`` and
+        ``p_value`` arrays. Voxels with no residual variance have zero
+        statistics and p-values of one.
+    Examples
+    --------
+    >>> maps = contrast_stats(
+    ...     np.array([[2.0, 0.0]]), np.array([[1.0]]), np.array([1.0, 1.0]), 10, 't'
+    ... )
+    >>> maps['stat'].tolist()
+    [2.0, 0.0]
+    >>> maps['p_value'].tolist()[1]
+    0.5
+    >>> maps = contrast_stats(
+    ...     np.array([[2.0], [1.0]]), np.diag([4.0, 1.0]), np.array([2.0]), 10, 'F'
+    ... )
+    >>> maps['effect_size'].tolist(), maps['effect_variance'].tolist(), maps['stat'].tolist()
+    ([[1.0], [1.0]], [[2.0]], [0.5])
+    """
+    from scipy import stats
+
+    sigma2 = np.asarray(sigma2)
+    proj = np.asarray(proj)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if test.lower() == 't':
+            effect = effect[:1]
+            if proj.ndim == 3:
+                variance = proj[:, 0, 0] * sigma2
+            else:
+                variance = proj[0, 0] * sigma2
+            stat = effect[0] / np.sqrt(variance)
+            p_value = stats.t.sf(stat, dof)
+            z_score = np.where(
+                stat > 0, stats.norm.isf(p_value), stats.norm.ppf(stats.t.cdf(stat, dof))
+            )
+        else:
+            n_rows = effect.shape[0]
+            if proj.ndim == 3:
+                effect = np.einsum('vij,jv->iv', _inv_sqrt(proj), effect)
+            else:
+                effect = _inv_sqrt(proj) @ effect
+            variance = sigma2
+            stat = (effect**2).sum(axis=0) / (n_rows * sigma2)
+            p_value = stats.f.sf(stat, n_rows, dof)
+            z_score = stats.norm.isf(p_value)
+    return {
+        'effect_size': effect,
+        'effect_variance': variance[None],
+        'stat': np.nan_to_num(stat),
+        'z_score': np.nan_to_num(z_score),
+        'p_value': np.nan_to_num(p_value, nan=1.0),
+    }
+
+
+class OLSResults:
+    """Ordinary least squares estimates, as produced by ``SufficientStats.fit``"""
+
+    def __init__(self, betas, sigma2, cov, dof):
+        self.betas = betas
+        self.sigma2 = sigma2
+        self.cov = cov
+        self.dof = dof
+
+    def select(self, features):
+        """Results for a subset of features, sharing the design"""
+        return OLSResults(self.betas[:, features], self.sigma2[features], self.cov, self.dof)
+
+    def contrast(self, weights, test):
+        """Contrast maps for a (n_rows x n_regressors) weight matrix"""
+        weights = np.atleast_2d(weights)
+        return contrast_stats(
+            weights @ self.betas, weights @ self.cov @ weights.T, self.sigma2, self.dof, test
+        )
+
+
+class MixedEffectsResults(OLSResults):
+    """Mixed effects estimates, as produced by ``fit_mixed_effects``
+    Parameter covariances differ between features, and already include the
+    residual variance.
+    """
+
+    def __init__(self, betas, cov, tau2, dof):
+        super().__init__(betas, np.ones(len(tau2)), cov, dof)
+        self.tau2 = tau2
+
+    def select(self, features):
+        return MixedEffectsResults(
+            self.betas[:, features], self.cov[features], self.tau2[features], self.dof
+        )
+
+
+class SufficientStats:
+    """Per-voxel sufficient statistics of an OLS model
+    Inputs are accumulated one at a time or in small batches, so that memory
+    is proportional to a single map times the number of regressors, rather
+    than to the number of inputs. Sums are kept in float64 to avoid
+    cancellation when residuals are computed. Inputs can later be removed as
+    well as added, and the statistics saved to be updated by a later run.
+    Examples
+    --------
+    >>> design = np.array([[1.0, 0.0], [1.0, 1.0], [1.0, 2.0]])
+    >>> data = np.array([[1.0, 2.0], [3.0, 2.0], [5.0, 2.0]])
+    >>> suff = SufficientStats(2, 2)
+    >>> suff.update(design[:2], data[:2])
+    >>> suff.update(design[2:], data[2:])
+    >>> results = suff.fit()
+    >>> (results.betas.round(6) + 0).tolist()
+    [[1.0, 2.0], [2.0, 0.0]]
+    >>> results.dof
+    1
+    >>> suff.update(design[2:], data[2:], sign=-1)
+    >>> suff.n_inputs, suff.n_zero.tolist()
+    (2, [0, 0])
+    """
+
+    def __init__(self, n_regressors, n_features):
+        self.n_inputs = 0
+        self.xtx = np.zeros((n_regressors, n_regressors))
+        self.xty = np.zeros((n_regressors, n_features))
+        self.yty = np.zeros(n_features)
+        self.n_zero = np.zeros(n_features, dtype=np.int64)
+
+    def update(self, design_rows, data, sign=1):
+        """Add (or, with ``sign=-1``, remove) rows of the design and their maps
+        ``design_rows`` is (n_inputs x n_regressors) and ``data`` is
+        (n_inputs x n_features).
+        """
+        design_rows = np.atleast_2d(np.asarray(design_rows, dtype=np.float64))
+        data = np.atleast_2d(data)
+        self.n_inputs += sign * design_rows.shape[0]
+        self.xtx += sign * design_rows.T @ design_rows
+        self.xty += sign * design_rows.T @ data
+        self.yty += sign * np.einsum('ij,ij->j', data, data, dtype=np.float64)
+        self.n_zero += sign * (data == 0).sum(axis=0)
+
+    @property
+    def mask(self):
+        """Features that are nonzero in every input"""
+        return self.n_zero == 0
+
+    def save(self, fname, **metadata):
+        """Save the statistics to a ``.npz`` file, with JSON-serializable metadata"""
+        np.savez(
+            fname,
+            n_inputs=self.n_inputs,
+            xtx=self.xtx,
+            xty=self.xty,
+            yty=self.yty,
+            n_zero=self.n_zero,
+            metadata=json.dumps(metadata),
+        )
+        return fname
+
+    @classmethod
+    def load(cls, fname):
+        """Load statistics saved with ``save``, returning them with their metadata"""
+        with np.load(fname) as saved:
+            suff = cls(*saved['xty'].shape)
+            suff.n_inputs = int(saved['n_inputs'])
+            for key in ('xtx', 'xty', 'yty', 'n_zero'):
+                setattr(suff, key, saved[key])
+            metadata = json.loads(str(saved['metadata']))
+        return suff, metadata
+
+    def fit(self):
+        """Solve the normal equations, returning an ``OLSResults``"""
+        cov, rank = design_cache.normal(self.xtx)
+        dof = self.n_inputs - rank
+        betas = cov @ self.xty
+        rss = np.maximum(self.yty - np.einsum('ij,ij->j', betas, self.xty), 0)
+        return OLSResults(betas, rss / max(dof, 1), cov, dof)
+
+
+PERMUTATION_BATCH_SIZE = 100
+CHUNK_SIZE = 10000
+
+# Set once per worker process by _init_permutations, to avoid pickling the
+# data with every batch
+_PERMUTATION_DATA = {}
+
+
+def _init_permutations(resid, design, weights, test):
+    """Precompute the parts of a permuted contrast statistic that do not change
+    Model rows are cast to the dtype of the residuals, so that statistics are
+    computed in the precision of the data.
+    """
+    weights = np.atleast_2d(weights)
+    if test.lower() == 't':
+        weights = weights[:1]
+    info = design_cache.design(design)
+    _PERMUTATION_DATA.update(
+        resid=resid,
+        rows=(weights @ info.pinv).astype(resid.dtype),
+        basis=info.basis.T.astype(resid.dtype),
+        proj_inv=np.linalg.pinv(design_cache.projection(design, weights)).astype(resid.dtype),
+        dof=design.shape[0] - info.rank,
+        test=test.lower(),
+    )
+
+
+def _transform_rows(rows, orders, signs):
+    """Apply row reorderings and sign flips to the data through the model rows
+    For data transformed as ``signs[:, None] * data[order]``, a row vector
+    ``r`` of the model satisfies ``r @ transformed == transformed_r @ data``,
+    so each transformation of the data becomes a new set of model rows.
+    """
+    out = np.empty((len(orders),) + rows.shape, dtype=rows.dtype)
+    for out_rows, order, sign in zip(out, orders, signs):
+        out_rows[:, order] = rows * sign
+    return out.reshape(-1, rows.shape[1])
+
+
+def _permuted_stats(orders, signs, chunk):
+    """Contrast statistics of a chunk of voxels for each transformation of the data"""
+    data = _PERMUTATION_DATA
+    resid = data['resid'][:, chunk]
+    n_perm, n_rows = len(orders), len(data['rows'])
+    effect = (_transform_rows(data['rows'], orders, signs) @ resid).reshape(n_perm, n_rows, -1)
+    fitted = _transform_rows(data['basis'], orders, signs) @ resid
+    fitted = fitted.reshape(n_perm, -1, resid.shape[1])
+    rss = np.einsum('ij,ij->j', resid, resid) - np.einsum('bij,bij->bj', fitted, fitted)
+    sigma2 = np.maximum(rss, 0) / data['dof']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if data['test'] == 't':
+            stat = effect[:, 0] * np.sqrt(data['proj_inv'][0, 0] / sigma2)
+        else:
+            quad = np.einsum('biv,ij,bjv->bv', effect, data['proj_inv'], effect)
+            stat = quad / (n_rows * sigma2)
+    return np.nan_to_num(stat, nan=-np.inf)
+
+
+def _permutation_batch(seed, n_perm, sign_flip, observed, chunk_size):
+    """Count exceedances of the observed statistics and record maximum statistics"""
+    rng = np.random.default_rng(seed)
+    n_inputs = _PERMUTATION_DATA['resid'].shape[0]
+    if sign_flip:
+        orders = np.tile(np.arange(n_inputs), (n_perm, 1))
+        signs = rng.choice([-1.0, 1.0], size=(n_perm, n_inputs))
+    else:
+        orders = np.argsort(rng.random((n_perm, n_inputs)), axis=1)
+        signs = np.ones((n_perm, n_inputs))
+
+    exceed = np.zeros(len(observed), dtype=np.int64)
+    max_stat = np.full(n_perm, -np.inf)
+    for start in range(0, len(observed), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        stat = _permuted_stats(orders, signs, chunk)
+        exceed[chunk] = (stat >= observed[chunk]).sum(axis=0)
+        max_stat = np.maximum(max_stat, stat.max(axis=1))
+    return exceed, max_stat
+
+
+def permutation_test(
+    data, design, weights, test, n_perm, seed=0, n_procs=1, chunk_size=CHUNK_SIZE, dtype=np.float64
+):
+    """Nonparametric p-values of a contrast by permutation or sign flipping
+    One-sample designs (a single regressor) are tested by flipping the signs
+    of the inputs. Other designs permute the residuals of the nuisance
+    regressors, following Freedman and Lane. Statistics for a batch of
+    permutations are evaluated as matrix products with the data. Batches are
+    seeded from ``seed``, so results do not depend on ``n_procs``, and are
+    spread over a pool of ``n_procs`` processes.
+    Parameters
+    ----------
+    data : (n_inputs, n_voxels) array
+        Input maps, one row per row of ``design``
+    design : (n_inputs, n_regressors) array
+        Design matrix
+    weights : (n_rows, n_regressors) array
+        Contrast weights; t-tests are one-sided and use the first row only
+    test : str
+        ``'t'`` or ``'F'``
+    n_perm : int
+        Number of random permutations
+    dtype : numpy dtype
+        Precision of the data and of the permuted statistics
+    Returns
+    -------
+    dict
+        ``p_value_perm``, the uncorrected voxelwise p-values, and
+        ``p_value_fwe``, p-values corrected with the distribution of the
+        maximum statistic across voxels
+    Examples
+    --------
+    >>> rng = np.random.default_rng(0)
+    >>> data = rng.normal(size=(12, 3)) + [0, 0, 3]
+    >>> design = np.ones((12, 1))
+    >>> pvals = permutation_test(data, design, [[1.0]], 't', 99)
+    >>> bool(pvals['p_value_perm'][2] == 0.01)
+    True
+    >>> bool((pvals['p_value_fwe'] >= pvals['p_value_perm']).all())
+    True
+    >>> pvals32 = permutation_test(data, design, [[1.0]], 't', 99, dtype=np.float32)
+    >>> bool(np.abs(pvals32['p_value_perm'] - pvals['p_value_perm']).max() <= 0.01)
+    True
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    design = np.asarray(design, dtype=np.float64)
+    weights = np.atleast_2d(weights)
+    sign_flip = design.shape[1] == 1
+    resid = np.asarray(data, dtype=dtype)
+    if not sign_flip:
+        # Residualize on the part of the design that the contrast does not test
+        _, sing, vh = np.linalg.svd(weights)
+        null = vh[(sing > sing.max() * max(weights.shape) * np.finfo(float).eps).sum() :].T
+        nuisance = (design @ null).astype(dtype)
+        resid = resid - nuisance @ (np.linalg.pinv(nuisance) @ resid)
+
+    n_inputs = len(design)
+    _init_permutations(resid, design, weights, test)
+    identity = np.arange(n_inputs)[None], np.ones((1, n_inputs))
+    observed = np.concatenate(
+        [
+            _permuted_stats(*identity, slice(start, start + chunk_size))[0]
+            for start in range(0, resid.shape[1], chunk_size)
+        ]
+    )
+
+    batch_sizes = [
+        min(PERMUTATION_BATCH_SIZE, n_perm - start)
+        for start in range(0, n_perm, PERMUTATION_BATCH_SIZE)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    jobs = [
+        (batch_seed, size, sign_flip, observed, chunk_size)
+        for batch_seed, size in zip(seeds, batch_sizes)
+    ]
+    if n_procs > 1:
+        with ProcessPoolExecutor(
+            max_workers=n_procs,
+            initializer=_init_permutations,
+            initargs=(resid, design, weights, test),
+        ) as executor:
+            results = list(executor.map(_permutation_batch, *zip(*jobs)))
+    else:
+        results = [_permutation_batch(*job) for job in jobs]
+
+    exceed = sum(result[0] for result in results)
+    max_stat = np.concatenate([result[1] for result in results])
+    p_value_perm = (1 + exceed) / (1 + n_perm)
+    p_value_fwe = (1 + (max_stat[:, None] >= observed).sum(axis=0)) / (1 + n_perm)
+    undefined = ~np.isfinite(observed)
+    p_value_perm[undefined] = 1
+    p_value_fwe[undefined] = 1
+    return {'p_value_perm': p_value_perm, 'p_value_fwe': p_value_fwe}
+
+
+def _mixed_effects_solve(y, v, design, tau2):
+    """Weighted least squares for each voxel, given its between-input variance"""
+    weights = 1 / np.maximum(tau2[:, None] + v, np.finfo(np.float32).tiny)
+    cov = np.linalg.pinv(np.einsum('bn,ni,nj->bij', weights, design, design))
+    betas = np.einsum('bij,bn,nj,bn->bi', cov, weights, design, y)
+    return weights, cov, betas
+
+
+def fit_mixed_effects(effects, variances, design, max_iter=50, tol=1e-6, dtype=np.float64):
+    """Fit a mixed effects GLM to input effects with known within-input variances
+    Each input ``i`` is modelled with variance ``tau2 + variances[i]``, as in
+    AFNI's 3dMEMA. The between-input variance ``tau2`` is estimated by REML
+    with Fisher scoring, updating all voxels at once and dropping voxels from
+    the batch as they converge. Only per-voxel (n_regressors x n_regressors)
+    matrices are formed, so memory is linear in the number of inputs.
+    Parameters
+    ----------
+    effects, variances : (n_inputs, n_voxels) arrays
+        Input effect estimates and their variances
+    design : (n_inputs, n_regressors) array
+        Design matrix
+    dtype : numpy dtype
+        Precision of the fit
+    Returns
+    -------
+    MixedEffectsResults
+    Examples
+    --------
+    >>> rng = np.random.default_rng(0)
+    >>> variances = rng.uniform(0.5, 2, size=(200, 1))
+    >>> effects = 1 + rng.normal(size=(200, 1)) * np.sqrt(4 + variances)
+    >>> results = fit_mixed_effects(effects, variances, np.ones((200, 1)))
+    >>> bool(abs(results.betas[0, 0] - 1) < 0.5), bool(abs(results.tau2[0] - 4) < 1.5)
+    (True, True)
+    >>> results32 = fit_mixed_effects(effects, variances, np.ones((200, 1)), dtype=np.float32)
+    >>> results32.betas.dtype
+    dtype('float32')
+    >>> bool(np.allclose(results32.betas, results.betas, rtol=1e-4))
+    True
+    >>> bool(np.allclose(results32.tau2, results.tau2, rtol=1e-3))
+    True
+    """
+    design = np.asarray(design, dtype=dtype)
+    y = np.asarray(effects, dtype=dtype).T
+    v = np.asarray(variances, dtype=dtype).T
+    info = design_cache.design(design)
+    dof = design.shape[0] - info.rank
+
+    # Start from the OLS residual variance in excess of the mean input variance
+    ols_betas = y @ info.pinv.T.astype(dtype)
+    rss = ((y - ols_betas @ design.T) ** 2).sum(axis=1)
+    tau2 = np.maximum(rss / max(dof, 1) - v.mean(axis=1), 0)
+
+    active = np.arange(len(tau2))
+    for _ in range(max_iter):
+        if not len(active):
+            break
+        weights, cov, betas = _mixed_effects_solve(y[active], v[active], design, tau2[active])
+        resid = y[active] - betas @ design.T
+        # Traces of the REML projection P = W - W X cov X' W and of P @ P
+        xtw2x = np.einsum('bn,ni,nj->bij', weights**2, design, design)
+        xtw3x = np.einsum('bn,ni,nj->bij', weights**3, design, design)
+        cov_w2 = cov @ xtw2x
+        trace_p = weights.sum(axis=1) - np.trace(cov_w2, axis1=1, axis2=2)
+        trace_pp = (
+            (weights**2).sum(axis=1)
+            - 2 * np.einsum('bij,bji->b', cov, xtw3x)
+            + np.einsum('bij,bji->b', cov_w2, cov_w2)
+        )
+        score = ((weights * resid) ** 2).sum(axis=1) - trace_p
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.nan_to_num(score / trace_pp)
+        new_tau2 = np.maximum(tau2[active] + step, 0)
+        scale = np.maximum(new_tau2, v[active].mean(axis=1))
+        converged = np.abs(new_tau2 - tau2[active]) <= tol * np.maximum(scale, 1e-12)
+        tau2[active] = new_tau2
+        active = active[~converged]
+
+    _, cov, betas = _mixed_effects_solve(y, v, design, tau2)
+    return MixedEffectsResults(betas.T, cov, tau2, dof)
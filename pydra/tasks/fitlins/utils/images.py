@@ -0,0 +1,353 @@
+import json
+import os
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nb
+import numpy as np
+
+from .loading import can_memmap, load_data, read_slab
+from .masks import compact_img, compact_reference
+
+
+def split_map_ref(ref):
+    """Split a map reference into its file and its index in a map container
+    The index is ``None`` for references to a plain image file.
+    """
+    path, sep, index = str(ref).rpartition('#')
+    if sep and index.isdigit():
+        return path, int(index)
+    return str(ref), None
+
+
+def container_index_file(fname):
+    """Sidecar index file of the map container ``fname``"""
+    base = os.path.basename(fname).split('.')[0]
+    return os.path.join(os.path.dirname(fname), base + '.json')
+
+
+class _MapProxy:
+    """Array proxy for one map of a container, read only when sliced or converted
+    Examples
+    --------
+    >>> proxy = _MapProxy(np.arange(24).reshape(2, 3, 4), 1, -1)
+    >>> proxy.shape
+    (2, 3)
+    >>> proxy[np.array([0, 1]), 0].tolist()
+    [1, 13]
+    >>> proxy[..., 2].tolist()
+    [9, 21]
+    """
+
+    is_proxy = True
+
+    def __init__(self, dataobj, index, axis):
+        self._dataobj = dataobj
+        self._index = index
+        self._axis = axis % len(dataobj.shape)
+        self.shape = tuple(n for ax, n in enumerate(dataobj.shape) if ax != self._axis)
+        self.ndim = len(self.shape)
+        self.dtype = getattr(dataobj, 'dtype', None)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        # Compare by identity, as array indices do not compare to a bool
+        if any(k is Ellipsis for k in key):
+            pos = next(i for i, k in enumerate(key) if k is Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:pos] + fill + key[pos + 1 :]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return self._dataobj[key[: self._axis] + (self._index,) + key[self._axis :]]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asanyarray(self[...])
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def load_map(ref):
+    """Load an image file, or a lazy view of one map of a container
+    Map references are ``"<container>#<index>"``. NIfTI containers hold maps
+    along their last axis, and their views are only read when their data are
+    accessed. CIFTI-2 containers are dscalar files with one map per scalar.
+    Views keep the container's header, so that views of compact in-mask
+    containers remain compact images.
+    """
+    path, index = split_map_ref(ref)
+    img = nb.load(path)
+    if index is None:
+        return img
+    if isinstance(img, nb.Cifti2Image):
+        scalars, brain_models = img.header.get_axis(0), img.header.get_axis(1)
+        # A dscalar row is small, and is read right away
+        return nb.Cifti2Image(
+            np.asanyarray(img.dataobj[index : index + 1]),
+            header=(scalars[index : index + 1], brain_models),
+            nifti_header=img.nifti_header,
+        )
+    return img.__class__(_MapProxy(img.dataobj, index, -1), img.affine, img.header)
+
+
+class DscalarFactory:
+    """Build dscalar CIFTI-2 images on the brain models of a source CIFTI-2 image
+    The brain model mapping and the NIfTI header are derived once from the
+    source image, so that each output only builds the scalar axis naming its
+    maps. Data of shape (n_maps x n_grayordinates) make multi-map dscalars,
+    named by a list of ``names``, or numbered after a single name.
+    Examples
+    --------
+    >>> brain_models = nb.cifti2.BrainModelAxis.from_mask(np.ones(3, bool), 'CortexLeft')
+    >>> series = nb.cifti2.SeriesAxis(0, 2, 4)
+    >>> make_dscalar = DscalarFactory(nb.Cifti2Image(np.zeros((4, 3)), (series, brain_models)))
+    >>> img = make_dscalar(np.ones((2, 3)), 'beta')
+    >>> img.shape, img.header.get_axis(0).name.tolist()
+    ((2, 3), ['beta 0', 'beta 1'])
+    >>> img.header.get_axis(1) == brain_models
+    True
+    """
+
+    def __init__(self, img):
+        # Clear old CIFTI-2 extensions from NIfTI header and set intent
+        nifti_header = img.nifti_header.copy()
+        nifti_header.extensions.clear()
+        nifti_header.set_intent('ConnDenseScalar')
+        self.nifti_header = nifti_header
+
+        axes = [nb.cifti2.cifti2_axes.from_index_mapping(mim) for mim in img.header.matrix]
+        if len(axes) != 2:
+            raise ValueError(f"Can't generate dscalar CIFTI-2 from header with axes {axes}")
+        # Brain model mappings are reused as they are; other axes take the scalar names
+        self._mappings = [
+            axis.to_mapping(dim) if isinstance(axis, nb.cifti2.BrainModelAxis) else None
+            for dim, axis in enumerate(axes)
+        ]
+        self._sizes = [len(axis) for axis in axes]
+        self._n_grayordinates = int(
+            np.prod([size for size, mim in zip(self._sizes, self._mappings) if mim is not None])
+        )
+
+    def __call__(self, data, names):
+        data = np.asanyarray(data)
+        if isinstance(names, str):
+            n_maps = data.size // self._n_grayordinates
+            names = [names] if n_maps == 1 else [f"{names} {ii}" for ii in range(n_maps)]
+        scalars = nb.cifti2.ScalarAxis(names)
+        matrix = nb.cifti2.Cifti2Matrix()
+        shape = []
+        for dim, (mim, size) in enumerate(zip(self._mappings, self._sizes)):
+            matrix.append(scalars.to_mapping(dim) if mim is None else mim)
+            shape.append(len(scalars) if mim is None else size)
+        return nb.Cifti2Image(
+            data.reshape(shape),
+            header=nb.cifti2.Cifti2Header(matrix),
+            nifti_header=self.nifti_header,
+        )
+
+
+_DSCALAR_FACTORIES = weakref.WeakKeyDictionary()
+
+
+def dscalar_factory(img):
+    """The ``DscalarFactory`` of ``img``, built on first use and kept while ``img`` lives"""
+    factory = _DSCALAR_FACTORIES.get(img)
+    if factory is None:
+        factory = _DSCALAR_FACTORIES[img] = DscalarFactory(img)
+    return factory
+
+
+def write_container(fname, imgs, index, dtype=np.float32):
+    """Write images of one kind into a single map container at ``fname``
+    NIfTI images (including compact in-mask images) are stacked along a new
+    last axis, and CIFTI-2 dscalar images are concatenated along their scalar
+    axis, named by each image's index entry ``"name"``. Maps are written in
+    ``dtype``. The ``index`` records are written as a JSON sidecar (see
+    ``container_index_file``).
+    Returns references to each map, to be loaded with ``load_map``.
+    Examples
+    --------
+    >>> import tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'maps.nii.gz')
+    >>> imgs = [nb.Nifti1Image(np.full((2, 2, 2), val, 'f4'), np.eye(4)) for val in (1, 2)]
+    >>> refs = write_container(fname, imgs, [{'name': 'a'}, {'name': 'b'}])
+    >>> [ref[len(fname):] for ref in refs]
+    ['#0', '#1']
+    >>> view = load_map(refs[1])
+    >>> view.shape, float(view.get_fdata().mean())
+    ((2, 2, 2), 2.0)
+    >>> load_stacked(refs)[0].mean(axis=1).tolist()
+    [1.0, 2.0]
+    """
+    if not isinstance(imgs[0], nb.Cifti2Image):
+        # Single volumes may carry a trailing singleton axis
+        imgs = [nb.funcs.squeeze_image(img) for img in imgs]
+    ref_img = imgs[0]
+    for img in imgs[1:]:
+        check_compatible(img, ref_img)
+    if isinstance(ref_img, nb.Cifti2Image):
+        out_img = dscalar_factory(ref_img)(
+            np.concatenate([img.get_fdata(dtype=dtype) for img in imgs]),
+            [str(entry['name']) for entry in index],
+        )
+    else:
+        data = np.stack([img.get_fdata(dtype=dtype) for img in imgs], axis=-1)
+        out_img = nb.Nifti1Image(data, ref_img.affine, ref_img.header)
+        out_img.set_data_dtype(dtype)
+    out_img.to_filename(fname)
+    with open(container_index_file(fname), 'w') as fobj:
+        json.dump(index, fobj, indent=2)
+    return [f"{fname}#{idx}" for idx in range(len(imgs))]
+
+
+class MapWriter:
+    """Save maps to their own files, or collect them into one map container
+    With a ``container`` file name, ``save`` returns the reference that each
+    map will have once ``close`` writes the container. If a compiled ``mask``
+    (of ``mask_file``) is given, full volumes are added to the container as
+    compact in-mask images. Containers are written in ``dtype``.
+    """
+
+    def __init__(self, container=None, mask_file=None, mask=None, dtype=np.float32):
+        self.container = container
+        self.mask_file = mask_file
+        self.mask = mask
+        self.dtype = dtype
+        self._imgs = []
+        self._index = []
+
+    def save(self, img, fname, name):
+        if self.container is None:
+            img.to_filename(fname)
+            return fname
+        if self.mask is not None and compact_reference(img) is None:
+            img = compact_img(
+                self.mask.apply(img, self.dtype).reshape(-1), self.mask_file, self.mask, self.dtype
+            )
+        self._imgs.append(img)
+        self._index.append({'name': name})
+        return f"{self.container}#{len(self._imgs) - 1}"
+
+    def close(self):
+        if self._imgs:
+            write_container(self.container, self._imgs, self._index, self.dtype)
+
+
+def check_compatible(img, ref_img, fname=None):
+    """Raise a ``ValueError`` if ``img`` is not on the same grid as ``ref_img``
+    NIfTI images must share shape and affine, and CIFTI-2 images must share
+    their brain model axis. Compact in-mask images must also reference the
+    same mask.
+    """
+    desc = f"Image {fname}" if fname else "Image"
+    if type(img) is not type(ref_img) or img.shape != ref_img.shape:
+        raise ValueError(
+            f"{desc} ({img.__class__.__name__}, shape {img.shape}) does not match "
+            f"reference ({ref_img.__class__.__name__}, shape {ref_img.shape})"
+        )
+    if isinstance(img, nb.Cifti2Image):
+        if img.header.get_axis(img.ndim - 1) != ref_img.header.get_axis(ref_img.ndim - 1):
+            raise ValueError(f"{desc} has different brain models from the reference image")
+    elif not np.allclose(img.affine, ref_img.affine, atol=1e-5):
+        raise ValueError(f"{desc} has a different affine from the reference image")
+    elif compact_reference(img) != compact_reference(ref_img):
+        raise ValueError(f"{desc} has a different in-mask reference from the reference image")
+
+
+def load_stacked(fnames, n_procs=1, dtype=np.float32):
+    """Load images into a single preallocated (n_images x n_features) array
+    The output array is allocated once, from the shape of the first image,
+    and filled by a pool of ``n_procs`` threads, each reading and decompressing
+    one file at a time. Every image is checked against the first with
+    ``check_compatible`` as it is loaded.
+    Parameters
+    ----------
+    fnames : list of str
+        NIfTI, CIFTI-2 or compact in-mask files, or references to maps of a
+        container (see ``load_map``)
+    n_procs : int
+        Number of reader threads
+    dtype : numpy dtype
+        Output data type
+    Returns
+    -------
+    data : (n_images, n_features) array
+        Flattened image data, one row per file
+    ref_img : nibabel image
+        The first image, whose header describes the features
+    """
+    ref_img = load_map(fnames[0])
+    data = np.empty((len(fnames), int(np.prod(ref_img.shape))), dtype=dtype)
+
+    def _load(idx):
+        img = ref_img if idx == 0 else load_map(fnames[idx])
+        check_compatible(img, ref_img, fnames[idx])
+        data[idx] = load_data(img, dtype).reshape(-1)
+
+    with ThreadPoolExecutor(max_workers=n_procs) as executor:
+        list(executor.map(_load, range(len(fnames))))
+
+    return data, ref_img
+
+
+def iter_stacked(fnames, batch_size, n_procs=1, dtype=np.float32, ref_img=None):
+    """Yield ``(start, data)`` batches of at most ``batch_size`` stacked images
+    Each batch is loaded with ``load_stacked`` and checked against ``ref_img``
+    (default: the first image), so that only one batch is held in memory at
+    a time.
+    """
+    if ref_img is None:
+        ref_img = load_map(fnames[0])
+    for start in range(0, len(fnames), batch_size):
+        data, batch_img = load_stacked(fnames[start : start + batch_size], n_procs, dtype)
+        check_compatible(batch_img, ref_img, fnames[start])
+        yield start, data
+
+
+def iter_blocks(fnames, block_size, n_procs=1, dtype=np.float32):
+    """Yield ``(index, data)`` blocks of features across all images
+    Blocks are slabs along the last image axis, each holding about
+    ``block_size`` features, so memory is bounded by the number of images
+    times ``block_size``. ``index`` holds the flat (C order) positions of the
+    columns of the (n_images x n_block) ``data``.
+    Slabs of uncompressed files are read from memory maps. Compressed images
+    (and maps of compressed containers) are decompressed once each, into
+    memory-mapped scratch files that are removed once all blocks are read,
+    rather than decompressed again for every block.
+    """
+    imgs = [load_map(fname) for fname in fnames]
+    for img, fname in zip(imgs[1:], fnames[1:]):
+        check_compatible(img, imgs[0], fname)
+    shape = imgs[0].shape
+    positions = np.arange(int(np.prod(shape))).reshape(shape)
+    step = max(1, block_size // int(np.prod(shape[:-1])))
+
+    with ThreadPoolExecutor(max_workers=n_procs) as executor, tempfile.TemporaryDirectory(
+        prefix='blocks'
+    ) as scratch:
+
+        def _spool(idx):
+            if can_memmap(imgs[idx]):
+                return imgs[idx]
+            spooled = np.lib.format.open_memmap(
+                os.path.join(scratch, f'{idx}.npy'), mode='w+', dtype=dtype, shape=shape
+            )
+            spooled[...] = load_data(imgs[idx], dtype)
+            return spooled
+
+        imgs = list(executor.map(_spool, range(len(imgs))))
+        for start in range(0, shape[-1], step):
+            index = positions[..., start : start + step].reshape(-1)
+            data = np.empty((len(imgs), len(index)), dtype=dtype)
+
+            def _load(idx):
+                data[idx] = read_slab(imgs[idx], start, start + step, dtype).reshape(-1)
+
+            list(executor.map(_load, range(len(imgs))))
+            yield index, data
+
+
+def stacked_to_img(data, ref_img):
+    """Wrap (n_images x n_voxels) data from ``load_stacked`` as a 4D NIfTI image
+    The returned image is a view on ``data``, with images along the last axis.
+    """
+    vols = np.moveaxis(data.reshape((-1,) + ref_img.shape), 0, -1)
+    return nb.Nifti1Image(vols, ref_img.affine, ref_img.header)
@@ -0,0 +1,104 @@
+import os
+
+import nibabel as nb
+import numpy as np
+
+
+def _is_compressed(fname):
+    return os.path.splitext(str(fname))[1] in nb.openers.Opener.compress_ext_map
+
+
+def can_memmap(img):
+    """Whether the raw data of ``img`` can be memory mapped from an uncompressed file"""
+    dataobj = getattr(img, 'dataobj', None)
+    return (
+        nb.is_proxy(dataobj)
+        and hasattr(dataobj, 'get_unscaled')
+        and not _is_compressed(dataobj.file_like)
+    )
+
+
+def _scale(raw, slope, inter, dtype):
+    """Apply scaling to raw on-disk values, in ``dtype`` where that loses no precision
+    Scale factors are 32-bit in NIfTI-1 files, so scaling in float32 is exact
+    for them; the 64-bit factors of NIfTI-2 (and CIFTI-2) files are only
+    used in float32 if they are representable to within 1e-7.
+    """
+    dtype = np.dtype(dtype)
+    if slope == 1 and inter == 0:
+        return raw.astype(dtype, copy=False)
+    slope_cast, inter_cast = dtype.type(slope), dtype.type(inter)
+    if np.isclose(slope_cast, slope, atol=1e-7, rtol=0) and np.isclose(
+        inter_cast, inter, atol=1e-7, rtol=0
+    ):
+        data = raw.astype(dtype)
+        data *= slope_cast
+        data += inter_cast
+        return data
+    return (raw * np.float64(slope) + np.float64(inter)).astype(dtype)
+
+
+def load_data(img, dtype=np.float32):
+    """Data of a NIfTI-1/2, CIFTI-2 or GIFTI image (or file) as an array of ``dtype``
+    Unscaled data of uncompressed files that are stored in ``dtype`` are
+    returned as memory maps, without reading the file. Otherwise,
+    the raw data are read once and scaled in place, in ``dtype`` wherever
+    this loses no precision, and are not cached by the image.
+    GIFTI data arrays are stacked into a single (n_arrays x n_vertices) array,
+    as the (time x grayordinates) data of CIFTI-2 series.
+    Examples
+    --------
+    >>> import tempfile
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'img.nii')
+    >>> nb.Nifti1Image(np.ones((2, 2, 2, 3), 'f4'), np.eye(4)).to_filename(fname)
+    >>> data = load_data(fname)
+    >>> type(data).__name__, data.dtype.name, data.shape
+    ('memmap', 'float32', (2, 2, 2, 3))
+    >>> scaled = nb.Nifti1Image(np.arange(8, dtype='i2').reshape(2, 2, 2), np.eye(4))
+    >>> scaled.header.set_slope_inter(0.5, 10)
+    >>> scaled.to_filename(fname)
+    >>> load_data(fname)[1, 1].tolist()
+    [13.0, 13.5]
+    >>> darrays = [nb.gifti.GiftiDataArray(np.full(4, val, 'f4')) for val in (1, 2)]
+    >>> load_data(nb.GiftiImage(darrays=darrays)).tolist()
+    [[1.0, 1.0, 1.0, 1.0], [2.0, 2.0, 2.0, 2.0]]
+    """
+    if not isinstance(img, nb.filebasedimages.FileBasedImage):
+        img = nb.load(img)
+    if isinstance(img, nb.GiftiImage):
+        darrays = img.darrays
+        out = np.empty((len(darrays),) + darrays[0].data.shape, dtype=dtype)
+        for row, darray in zip(out, darrays):
+            row[...] = darray.data
+        return out
+    dataobj = img.dataobj
+    if not nb.is_proxy(dataobj) or not hasattr(dataobj, 'get_unscaled'):
+        return np.asanyarray(dataobj, dtype=dtype)
+    return _scale(dataobj.get_unscaled(), dataobj.slope, dataobj.inter, dtype)
+
+
+def read_slab(img, start, stop, dtype=np.float32):
+    """Data of ``img`` from ``start`` to ``stop`` along its last axis, in ``dtype``
+    Slabs of uncompressed files are sliced from a memory map of the raw
+    data, and slabs of compressed files are decompressed up to ``stop``.
+    """
+    if can_memmap(img):
+        raw = img.dataobj.get_unscaled()[..., start:stop]
+        return _scale(raw, img.dataobj.slope, img.dataobj.inter, dtype)
+    dataobj = img.dataobj if isinstance(img, nb.dataobj_images.DataobjImage) else img
+    return np.asanyarray(dataobj[..., start:stop]).astype(dtype, copy=False)
+
+
+def iter_slabs(img, slab_size, dtype=np.float32):
+    """Yield ``(start, data)`` slabs of at most ``slab_size`` along the last axis of ``img``
+    For a 4D series, slabs are batches of volumes, so that streaming consumers
+    never hold the full series in memory.
+    Examples
+    --------
+    >>> img = nb.Nifti1Image(np.arange(40, dtype='i2').reshape(2, 2, 2, 5), np.eye(4))
+    >>> [(start, slab.shape, slab.dtype.name) for start, slab in iter_slabs(img, 2)]
+    [(0, (2, 2, 2, 2), 'float32'), (2, (2, 2, 2, 2), 'float32'), (4, (2, 2, 2, 1), 'float32')]
+    """
+    dataobj = img.dataobj if isinstance(img, nb.dataobj_images.DataobjImage) else img
+    for start in range(0, dataobj.shape[-1], slab_size):
+        yield start, read_slab(img, start, start + slab_size, dtype)
@@ -0,0 +1,192 @@
+import json
+import os
+from functools import lru_cache
+
+import nibabel as nb
+import numpy as np
+
+from .loading import load_data
+
+
+class CompiledMask:
+    """A brain mask compiled to flat (C order) voxel indices on an image grid
+    Masking and unmasking index the flattened data directly, so a mask that is
+    shared by many runs in the same space is only loaded, resampled and
+    indexed once.
+    Examples
+    --------
+    >>> mask = np.zeros((2, 2, 2), dtype=bool)
+    >>> mask[0, 1, 1] = mask[1, 0, 0] = True
+    >>> compiled = CompiledMask(mask, np.eye(4))
+    >>> compiled.n_voxels
+    2
+    >>> data = np.arange(16, dtype=float).reshape(2, 2, 2, 2)
+    >>> compiled.apply(data).tolist()
+    [[6.0, 8.0], [7.0, 9.0]]
+    >>> compiled.unmask([1.0, 2.0]).get_fdata()[mask].tolist()
+    [1.0, 2.0]
+    """
+
+    def __init__(self, mask, affine):
+        mask = np.asanyarray(mask).astype(bool)
+        self.shape = mask.shape
+        self.affine = np.asarray(affine)
+        self.indices = np.flatnonzero(mask)
+        self.indices.setflags(write=False)
+
+    @property
+    def n_voxels(self):
+        return len(self.indices)
+
+    @property
+    def mask(self):
+        """Boolean mask array"""
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.shape)
+
+    def mask_img(self):
+        return nb.Nifti1Image(self.mask.astype(np.uint8), self.affine)
+
+    def restrict(self, keep):
+        """Compiled mask of the in-mask voxels selected by the boolean ``keep``"""
+        restricted = CompiledMask.__new__(CompiledMask)
+        restricted.shape = self.shape
+        restricted.affine = self.affine
+        restricted.indices = self.indices[np.asanyarray(keep, dtype=bool)]
+        restricted.indices.setflags(write=False)
+        return restricted
+
+    def apply(self, img, dtype=np.float32):
+        """In-mask data of a 3D or 4D image (or array), as C-ordered (n_vols x n_voxels)"""
+        if isinstance(img, nb.spatialimages.SpatialImage):
+            data = load_data(img, dtype)
+        else:
+            data = np.asanyarray(img, dtype=dtype)
+        if data.shape[:3] != self.shape:
+            raise ValueError(f"Image of shape {data.shape} does not match mask {self.shape}")
+        if data.ndim > 3 and data.flags.f_contiguous:
+            # Index NIfTI (Fortran order) data in place, rather than copying it to C order
+            indices = np.ravel_multi_index(
+                np.unravel_index(self.indices, self.shape), self.shape, order='F'
+            )
+            return np.ascontiguousarray(data.reshape((-1,) + data.shape[3:], order='F')[indices].T)
+        return np.ascontiguousarray(data.reshape((-1,) + data.shape[3:])[self.indices].T)
+
+    def unmask(self, values, header=None):
+        """Image of in-mask values
+        A vector of values makes a 3D image, and a (n_maps x n_voxels) array a
+        4D image, as with nilearn's ``NiftiMasker.inverse_transform``.
+        """
+        values = np.asanyarray(values)
+        full = np.zeros(values.shape[:-1] + (int(np.prod(self.shape)),), dtype=values.dtype)
+        full[..., self.indices] = values
+        vols = np.moveaxis(full.reshape((-1,) + self.shape), 0, -1)
+        return nb.Nifti1Image(vols.reshape(self.shape + values.shape[:-1]), self.affine, header)
+
+
+@lru_cache(maxsize=32)
+def _compile_mask(fingerprint, shape, affine):
+    mask_img = nb.load(fingerprint[0])
+    affine = np.array(affine).reshape(4, 4)
+    if mask_img.shape[:3] != shape or not np.allclose(mask_img.affine, affine, atol=1e-5):
+        from nilearn.image import resample_img
+
+        mask_img = resample_img(
+            mask_img, target_affine=affine, target_shape=shape, interpolation='nearest'
+        )
+    return CompiledMask(np.asanyarray(mask_img.dataobj) > 0, affine)
+
+
+def _mask_on_grid(mask_file, shape, affine):
+    fstat = os.stat(mask_file)
+    fingerprint = (os.path.abspath(mask_file), fstat.st_size, fstat.st_mtime_ns)
+    affine = tuple(np.asarray(affine, dtype=float).round(6).ravel())
+    return _compile_mask(fingerprint, tuple(shape[:3]), affine)
+
+
+def compile_mask(mask_file, target_img):
+    """Compile ``mask_file`` on the grid of ``target_img``
+    Compiled masks are cached by the mask file's path, size and modification
+    time, and by the target grid. Masks on a different grid are resampled
+    with nearest-neighbour interpolation.
+    """
+    return _mask_on_grid(mask_file, target_img.shape, target_img.affine)
+
+
+COMPACT_EXTENSION = '.inmask.nii'
+
+
+def is_compact(fname):
+    """Whether ``fname`` names a compact in-mask image"""
+    return str(fname).endswith(COMPACT_EXTENSION)
+
+
+def compact_img(values, mask_file, mask, dtype=np.float32):
+    """Compact image of the in-mask ``values`` of ``mask``, compiled from ``mask_file``
+    Compact images hold one value (of ``dtype``) per in-mask voxel, with a vector of
+    values making a (n_voxels,) image and a (n_maps x n_voxels) array a
+    (n_voxels x n_maps) image. A JSON header extension references the mask
+    file and the grid it was compiled on, so that the full volumes can be
+    recovered with ``expand_compact``. Saved uncompressed, as
+    ``COMPACT_EXTENSION`` files, compact images are memory-mapped on load.
+    Examples
+    --------
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> mask_file = os.path.join(tmpdir, 'mask.nii.gz')
+    >>> mask_data = np.zeros((2, 2, 2), dtype=np.uint8)
+    >>> mask_data[0, 1, 1] = mask_data[1, 0, 0] = 1
+    >>> nb.Nifti1Image(mask_data, np.eye(4)).to_filename(mask_file)
+    >>> mask = compile_mask(mask_file, nb.Nifti1Image(mask_data, np.eye(4)))
+    >>> fname = os.path.join(tmpdir, 'stat' + COMPACT_EXTENSION)
+    >>> compact_img([1.0, 2.0], mask_file, mask).to_filename(fname)
+    >>> img = nb.load(fname)
+    >>> img.shape, compact_mask(img).n_voxels
+    ((2,), 2)
+    >>> expand_compact(img).get_fdata()[mask.mask].tolist()
+    [1.0, 2.0]
+    """
+    values = np.asanyarray(values, dtype=dtype)
+    img = nb.Nifti1Image(np.ascontiguousarray(values.T), mask.affine)
+    reference = {'MaskFile': os.path.abspath(mask_file), 'GridShape': list(mask.shape)}
+    img.header.extensions.append(
+        nb.nifti1.Nifti1Extension('comment', json.dumps({'InMask': reference}).encode())
+    )
+    return img
+
+
+def compact_reference(img):
+    """Mask reference of a compact image, or ``None`` for any other image"""
+    header = getattr(img, 'header', None)
+    for ext in getattr(header, 'extensions', ()):
+        if ext.get_code() != 6:
+            continue
+        try:
+            return json.loads(ext.get_content())['InMask']
+        except (ValueError, KeyError, TypeError):
+            continue
+    return None
+
+
+def compact_mask(img):
+    """Compiled mask whose voxels are the values of the compact ``img``"""
+    reference = compact_reference(img)
+    if reference is None:
+        raise ValueError("Image has no in-mask reference")
+    mask = _mask_on_grid(reference['MaskFile'], reference['GridShape'], img.affine)
+    if mask.n_voxels != img.shape[0]:
+        raise ValueError(
+            f"Compact image has {img.shape[0]} values, "
+            f"but mask {reference['MaskFile']} has {mask.n_voxels} voxels"
+        )
+    return mask
+
+
+def expand_compact(img):
+    """Full NIfTI volume(s) of a compact image or file"""
+    if not isinstance(img, nb.spatialimages.SpatialImage):
+        img = nb.load(img)
+    header = nb.Nifti1Header()
+    header['descrip'] = img.header['descrip']
+    return compact_mask(img).unmask(np.asanyarray(img.dataobj).T, header)
@@ -0,0 +1,102 @@
+import os
+
+import attr
+
+
+def get_n_procs(n_procs=None):
+    """Resolve the number of CPUs a task may use
+    Unset values (``None`` or ``attr.NOTHING``) mean a single CPU, so tasks
+    only go parallel when explicitly granted an allowance. Requests larger
+    than the CPUs available to this process are clipped.
+    Examples
+    --------
+    >>> get_n_procs()
+    1
+    >>> get_n_procs(attr.NOTHING)
+    1
+    >>> get_n_procs(1)
+    1
+    """
+    if n_procs in [None, attr.NOTHING]:
+        return 1
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on all platforms
+        available = os.cpu_count() or 1
+    return max(1, min(int(n_procs), available))
+
+
+def run_dag(steps, n_procs=1):
+    """Run a graph of dependent steps, running independent steps concurrently
+    Each step is a ``(function, dependencies)`` pair, keyed by name. A step is
+    called once all of its dependencies have finished, with their results
+    passed as keyword arguments named after the dependencies. Steps run on a
+    pool of ``n_procs`` threads, which suits both in-process steps that release
+    the GIL and steps that wait on a subprocess.
+    Returns a dictionary of results, in the order of ``steps``.
+    Examples
+    --------
+    >>> steps = {
+    ...     'a': (lambda: 1, []),
+    ...     'b': (lambda a: a + 1, ['a']),
+    ...     'c': (lambda a, b: a + b, ['a', 'b']),
+    ... }
+    >>> run_dag(steps, n_procs=2)
+    {'a': 1, 'b': 2, 'c': 3}
+    >>> run_dag({'a': (lambda b: b, ['b']), 'b': (lambda a: a, ['a'])})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unsatisfiable dependencies for steps: a, b
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    missing = {dep for _, deps in steps.values() for dep in deps} - set(steps)
+    if missing:
+        raise ValueError(f"Unknown step dependencies: {', '.join(sorted(missing))}")
+
+    results = {}
+    pending = dict(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_procs) as executor:
+        while pending or running:
+            ready = [
+                name for name, (_, deps) in pending.items() if all(dep in results for dep in deps)
+            ]
+            for name in ready:
+                func, deps = pending.pop(name)
+                running[executor.submit(func, **{dep: results[dep] for dep in deps})] = name
+            if not running:
+                raise ValueError(f"Unsatisfiable dependencies for steps: {', '.join(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return {name: results[name] for name in steps}
+
+
+def prefetch(func, items, depth=1):
+    """Yield ``func(item)`` for each of ``items`` in order, computing results ahead
+    Results are computed in a background thread, up to ``depth`` items ahead
+    of the result being consumed, so that loading the next items overlaps with
+    processing the current one while at most ``depth`` results are held in
+    waiting. With ``depth=0``, each result is only computed once it is needed.
+    Exceptions are raised when the result that failed is reached.
+    Examples
+    --------
+    >>> list(prefetch(lambda x: x * 2, range(5), depth=2))
+    [0, 2, 4, 6, 8]
+    >>> list(prefetch(lambda x: x * 2, [], depth=2))
+    []
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import islice
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        queue = deque(executor.submit(func, item) for item in islice(items, depth))
+        for item in items:
+            queue.append(executor.submit(func, item))
+            yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
@@ -0,0 +1,128 @@
+import os
+from functools import lru_cache
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+
+from .loading import iter_slabs
+
+
+class CompiledAtlas:
+    """A labelled atlas compiled to a sparse parcel-averaging operator
+    ``weights`` is a (n_parcels x n_voxels) sparse matrix over the flattened
+    (C order) image grid, whose rows average the voxels of each parcel, so
+    that parcel means of any number of maps take a single matrix product.
+    Examples
+    --------
+    >>> atlas = np.array([[[1, 1], [2, 0]], [[2, 2], [0, 3]]])
+    >>> compiled = CompiledAtlas(atlas, np.eye(4))
+    >>> compiled.labels.tolist()
+    [1, 2, 3]
+    >>> data = np.arange(16, dtype=float).reshape(2, 2, 2, 2)
+    >>> compiled.means(data, dtype=float).round(2).tolist()
+    [[1.0, 7.33, 14.0], [2.0, 8.33, 15.0]]
+    """
+
+    def __init__(self, atlas, affine, mask=None):
+        from scipy import sparse
+
+        atlas = np.asanyarray(atlas).astype(int)
+        if mask is not None:
+            atlas = np.where(mask, atlas, 0)
+        self.shape = atlas.shape
+        self.affine = np.asarray(affine)
+        flat = atlas.reshape(-1)
+        voxels = np.flatnonzero(flat > 0)
+        self.labels, rows, counts = np.unique(
+            flat[voxels], return_inverse=True, return_counts=True
+        )
+        self.weights = sparse.csr_matrix(
+            (1.0 / counts[rows], (rows, voxels)), shape=(len(self.labels), flat.size)
+        )
+
+    @property
+    def n_parcels(self):
+        return len(self.labels)
+
+    def reduce(self, data):
+        """Parcel means of (n_maps x n_voxels) flattened data"""
+        return np.asarray(self.weights @ np.asanyarray(data).T).T
+
+    def means(self, img, batch_size=100, dtype=np.float32):
+        """Parcel means of a 3D or 4D image (or array), as (n_vols x n_parcels)
+        Volumes are read ``batch_size`` at a time, so that the full series is
+        never held in memory.
+        """
+        dataobj = img.dataobj if isinstance(img, nb.spatialimages.SpatialImage) else img
+        if dataobj.shape[:3] != self.shape:
+            raise ValueError(f"Image of shape {dataobj.shape} does not match atlas {self.shape}")
+        if len(dataobj.shape) == 3:
+            data = np.asanyarray(dataobj, dtype=dtype).reshape(1, -1)
+            return self.reduce(data)[0]
+        out = np.empty((dataobj.shape[3], self.n_parcels), dtype=dtype)
+        for start, batch in iter_slabs(img, batch_size, dtype):
+            out[start : start + batch.shape[3]] = self.reduce(batch.reshape(-1, batch.shape[3]).T)
+        return out
+
+
+@lru_cache(maxsize=8)
+def _compile_atlas(fingerprint, mask_indices, shape, affine):
+    atlas_img = nb.load(fingerprint[0])
+    affine = np.array(affine).reshape(4, 4)
+    if atlas_img.shape[:3] != shape or not np.allclose(atlas_img.affine, affine, atol=1e-5):
+        from nilearn.image import resample_img
+
+        atlas_img = resample_img(
+            atlas_img, target_affine=affine, target_shape=shape, interpolation='nearest'
+        )
+    mask = None
+    if mask_indices is not None:
+        mask = np.zeros(int(np.prod(shape)), dtype=bool)
+        mask[np.frombuffer(mask_indices, dtype=np.intp)] = True
+        mask = mask.reshape(shape)
+    return CompiledAtlas(np.asanyarray(atlas_img.dataobj), affine, mask)
+
+
+def compile_atlas(atlas_file, target_img, mask=None):
+    """Compile the labelled ``atlas_file`` on the grid of ``target_img``
+    Voxels labelled 0, or outside of the optional ``CompiledMask``, belong to
+    no parcel. As with masks, compiled atlases are cached by file identity
+    and target grid, and atlases on another grid are resampled with
+    nearest-neighbour interpolation.
+    """
+    fstat = os.stat(atlas_file)
+    fingerprint = (os.path.abspath(atlas_file), fstat.st_size, fstat.st_mtime_ns)
+    affine = tuple(np.asarray(target_img.affine, dtype=float).round(6).ravel())
+    mask_indices = None if mask is None else mask.indices.astype(np.intp).tobytes()
+    return _compile_atlas(fingerprint, mask_indices, tuple(target_img.shape[:3]), affine)
+
+
+class ParcelMap:
+    """Values of one or more maps in each parcel, saved as a TSV table
+    Parcel maps stand in for images wherever outputs are written with
+    ``to_filename``. Each map is a column, and each parcel a row indexed by
+    its atlas label. Several maps with one name are numbered.
+    """
+
+    def __init__(self, labels, values, names):
+        values = np.atleast_2d(values)
+        if isinstance(names, str):
+            names = [names] if len(values) == 1 else [f"{names} {ii}" for ii in range(len(values))]
+        self.table = pd.DataFrame(values.T, index=pd.Index(labels, name='parcel'), columns=names)
+
+    def to_filename(self, fname):
+        self.table.to_csv(fname, sep='\t')
+
+
+def load_parcel_maps(fnames):
+    """Load single-map parcel tables into a (n_maps x n_parcels) array
+    Returns the stacked values and the parcel labels, which must be the same
+    in every table.
+    """
+    tables = [pd.read_csv(fname, sep='\t', index_col=0) for fname in fnames]
+    labels = tables[0].index.values
+    for table, fname in zip(tables[1:], fnames[1:]):
+        if not np.array_equal(table.index.values, labels):
+            raise ValueError(f"Parcel table {fname} has different parcels from {fnames[0]}")
+    return np.stack([table.values[:, 0] for table in tables]).astype(np.float32), labels
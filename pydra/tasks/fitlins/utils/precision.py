@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+import attr
+import numpy as np
+
+Precision = namedtuple('Precision', ('data', 'solve'))
+
+
+def get_precision(precision=None):
+    """Resolve a precision policy to the dtypes of loaded data and of model fits
+    Unset values (``None`` or ``attr.NOTHING``) hold data in float32 and fit
+    models in float64. ``'float32'`` and ``'float64'`` use a single dtype from
+    loading to output writing.
+    Examples
+    --------
+    >>> get_precision()
+    Precision(data=dtype('float32'), solve=dtype('float64'))
+    >>> get_precision('float32')
+    Precision(data=dtype('float32'), solve=dtype('float32'))
+    >>> get_precision('float16')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown precision float16; expected float32 or float64
+    """
+    if precision in [None, attr.NOTHING]:
+        return Precision(np.dtype(np.float32), np.dtype(np.float64))
+    if precision not in ('float32', 'float64'):
+        raise ValueError(f"Unknown precision {precision}; expected float32 or float64")
+    return Precision(np.dtype(precision), np.dtype(precision))
+
+
+def cast_results(results, dtype):
+    """Narrow the voxelwise arrays of nilearn regression results to ``dtype``, in place
+    nilearn fits models in float64 whatever the dtype of the data; casting
+    the parameter estimates, data and residuals that the results keep for
+    contrasts halves their memory when fitting in float32. Arrays that are
+    already narrower than ``dtype`` are left as they are.
+    Examples
+    --------
+    >>> from nilearn.glm.contrasts import compute_contrast
+    >>> from nilearn.glm.first_level import run_glm
+    >>> rng = np.random.default_rng(0)
+    >>> design = np.column_stack([np.sin(np.arange(100) / 5), np.ones(100)])
+    >>> data = 100 + rng.normal(size=(100, 50)).cumsum(axis=0) + 2 * design[:, :1]
+    >>> z_scores = {}
+    >>> for dtype in (np.float32, np.float64):
+    ...     labels, results = run_glm(data.astype(dtype), design.astype(dtype))
+    ...     results = cast_results(results, dtype)
+    ...     z_scores[dtype] = compute_contrast(labels, results, [1, 0], 't').z_score()
+    >>> bool(np.abs(z_scores[np.float32] - z_scores[np.float64]).max() < 1e-4)
+    True
+    """
+    for result in results.values():
+        for name in ('theta', 'Y', 'whitened_Y', 'whitened_residuals', 'dispersion'):
+            value = getattr(result, name, None)
+            if isinstance(value, np.ndarray) and value.dtype.itemsize > np.dtype(dtype).itemsize:
+                setattr(result, name, value.astype(dtype))
+    return results
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+def _half_offsets(radius, voxel_size):
+    """Integer voxel offsets within ``radius`` mm, one of each +/- pair"""
+    extent = np.floor(radius / voxel_size).astype(int)
+    grid = np.stack(
+        np.meshgrid(*[np.arange(-ext, ext + 1) for ext in extent], indexing='ij'), -1
+    ).reshape(-1, 3)
+    dist = np.sqrt(((grid * voxel_size) ** 2).sum(1))
+    # Keep offsets whose first nonzero component is positive
+    first = np.array([row[np.flatnonzero(row)[0]] if row.any() else 0 for row in grid])
+    keep = (first > 0) & (dist <= radius)
+    return grid[keep], dist[keep]
+
+
+def _shifted_slices(offset, shape):
+    src, dst = [], []
+    for off, size in zip(offset, shape):
+        if off >= 0:
+            src.append(slice(0, size - off))
+            dst.append(slice(off, size))
+        else:
+            src.append(slice(-off, size))
+            dst.append(slice(0, size + off))
+    return tuple(src), tuple(dst)
+
+
+def acf_model(r, a, b, c):
+    """Mixed Gaussian and mono-exponential spatial autocorrelation model
+    This is the model fit by ``3dFWHMx -acf``.
+    Examples
+    --------
+    >>> float(acf_model(0, 0.5, 2.0, 5.0))
+    1.0
+    """
+    return a * np.exp(-0.5 * r * r / (b * b)) + (1 - a) * np.exp(-r / c)
+
+
+def estimate_smoothness(resid, mask, voxel_size, radius=None, chunk_size=32):
+    """Estimate the smoothness of residuals held in memory
+    Spatial autocorrelations are computed from the differences between
+    in-mask neighbours at every offset within ``radius`` mm, accumulating
+    over volumes in chunks of ``chunk_size``. The unit offsets along each
+    axis give the classic FWHM estimates, and the mixed ACF model
+    (see ``acf_model``) is fit to the autocorrelations at all offsets,
+    matching the two rows reported by AFNI's 3dFWHMx.
+    Parameters
+    ----------
+    resid : (n_vols, n_voxels) array
+        Residual time series of the voxels in ``mask``, in C order
+    mask : 3D boolean array
+        Brain mask
+    voxel_size : sequence of float
+        Voxel dimensions in mm
+    radius : float
+        Largest neighbour distance in mm (default: three times the largest
+        voxel dimension)
+    Returns
+    -------
+    fwhm : (4,) array
+        Classic FWHM along x, y and z and their geometric mean, in mm
+    acf : (4,) array
+        ACF parameters ``a``, ``b``, ``c`` and the diameter in mm at which
+        the ACF model falls to 0.5
+    """
+    from scipy.optimize import brentq, least_squares
+
+    mask = np.asarray(mask, dtype=bool)
+    voxel_size = np.asarray(voxel_size[:3], dtype=float)
+    if radius is None:
+        radius = 3 * voxel_size.max()
+    offsets, dist = _half_offsets(radius, voxel_size)
+    slices = [_shifted_slices(offset, mask.shape) for offset in offsets]
+    pairs = [mask[src] & mask[dst] for src, dst in slices]
+    n_pairs = np.array([pair.sum() for pair in pairs], dtype=float)
+
+    n_vols = resid.shape[0]
+    total_sq = 0.0
+    diff_sq = np.zeros(len(offsets))
+    grid = np.zeros((min(chunk_size, n_vols),) + mask.shape, dtype=np.float32)
+    for start in range(0, n_vols, chunk_size):
+        chunk = resid[start : start + chunk_size]
+        chunk = chunk - chunk.mean(axis=1, keepdims=True)
+        n_chunk = len(chunk)
+        grid[:n_chunk, mask] = chunk
+        total_sq += float((chunk.astype(np.float64) ** 2).sum())
+        for ii, ((src, dst), pair) in enumerate(zip(slices, pairs)):
+            diff = (grid[(slice(0, n_chunk),) + src] - grid[(slice(0, n_chunk),) + dst])[:, pair]
+            diff_sq[ii] += float(np.einsum('ij,ij->', diff, diff, dtype=np.float64))
+
+    variance = total_sq / (n_vols * mask.sum())
+    valid = n_pairs > 0
+    acf_vals = np.zeros(len(offsets))
+    acf_vals[valid] = 1 - diff_sq[valid] / (n_pairs[valid] * n_vols * 2 * variance)
+
+    # Classic estimates from unit offsets along each axis
+    fwhm = np.zeros(4)
+    for axis in range(3):
+        unit = np.flatnonzero((offsets == np.eye(3, dtype=int)[axis]).all(1))
+        if len(unit) and 0 < acf_vals[unit[0]] < 1:
+            rho = acf_vals[unit[0]]
+            fwhm[axis] = voxel_size[axis] * np.sqrt(-2 * np.log(2) / np.log(rho))
+    if (fwhm[:3] > 0).all():
+        fwhm[3] = np.cbrt(fwhm[:3].prod())
+
+    # Mixed model fit over all offsets
+    init_width = fwhm[3] / np.sqrt(8 * np.log(2)) if fwhm[3] > 0 else voxel_size.mean()
+    fit = least_squares(
+        lambda params: acf_model(dist[valid], *params) - acf_vals[valid],
+        x0=[0.5, init_width, init_width],
+        bounds=([0, 1e-3, 1e-3], [1, np.inf, np.inf]),
+    )
+    a, b, c = fit.x
+
+    def half_max(r):
+        return acf_model(r, a, b, c) - 0.5
+
+    upper = radius
+    while half_max(upper) > 0 and upper < 1e3 * radius:
+        upper *= 2
+    acf = np.array([a, b, c, 2 * brentq(half_max, 0, upper) if half_max(upper) < 0 else 0])
+
+    return fwhm, acf
+
+
+def write_smoothness(fname, fwhm, acf):
+    """Write smoothness estimates as a two-row TSV, in the layout of 3dFWHMx"""
+    with open(fname, 'w') as fobj:
+        for row in (fwhm, acf):
+            fobj.write('\t'.join(f'{val:g}' for val in row) + '\n')
+    return fname